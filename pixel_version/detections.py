@@ -4,6 +4,33 @@ import numpy as np
 import healpy as hp
 import joblib
 import h5py
+import os
+import sys
+
+# multi-order maps are read with the module that writes them
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'pofd'))
+import moc
+
+
+def _load_product(path):
+    """Loads a p(det) product, memory-mapped if it was stored as .npy
+
+    Parameters
+    ---------
+    path: str
+        Path of the product. The .npy version written by the pofd code
+        is used if present, the pickle otherwise. Multi-order maps are
+        returned as a regular map at the nside of their maximum order, see
+        moc.openMap, so that all the maps of one setup share an nside
+    """
+    stem = os.path.splitext(path)[0]
+    if moc.isMoc(path):
+        return moc.openMap(path)
+    if os.path.exists(stem + '.npy'):
+        return np.load(stem + '.npy', mmap_mode='r')
+    return joblib.load(path)
+
 
 class Event(object):
     """Convenience object holding information about a detection.
@@ -156,7 +183,7 @@ class Event(object):
     @pofd.setter
     def pofd(self, path):
         try:
-            self._pofd = joblib.load(path)
+            self._pofd = _load_product(path)
         except IOError:
             raise IOError('bad file')
 
@@ -217,10 +244,21 @@ class Event(object):
                                old_centres[1, :], old_centres[2, :])
         return pofd[old_order]
 
-    def rotate_pofd(self, rotmat):
+    def rotate_pofd(self, rotmat, cache=None):
+        """Rotated pofd map. With a rotcache.RotationCache the rotated pixel
+        indices are looked up there, shared with maps of the same nside"""
+        if cache is not None:
+            old_order = cache.lookup(rotmat, ('pixels', self._nside),
+                                     self._rotated_pixels)
+            return self.pofd[old_order]
         return self._rotate_pofd(rotmat, self.pofd, self._nside,
                                  self._pofd_pixel_vectors)
 
+    def _rotated_pixels(self, rotmat):
+        old_centres = np.matmul(rotmat.T, self._pofd_pixel_vectors)
+        return hp.vec2pix(self._nside, old_centres[0, :], old_centres[1, :],
+                          old_centres[2, :]).astype(np.int32)
+
 
 class Run(object):
     """Convenience object holding information about an observing run.
@@ -284,10 +322,17 @@ class Run(object):
     @pofd.setter
     def pofd(self, path):
         try:
-            self._pofd = joblib.load(path)
+            self._pofd = _load_product(path)
         except IOError:
             raise IOError('bad file')
 
-    def rotate_pofd(self, rotmat):
+    def rotate_pofd(self, rotmat, cache=None):
+        """Rotated pofd map, see Event.rotate_pofd"""
+        if cache is not None:
+            old_order = cache.lookup(rotmat, ('pixels', self._nside),
+                                     self._rotated_pixels)
+            return self.pofd[old_order]
         return Event._rotate_pofd(rotmat, self.pofd, self._nside,
                                   self._pofd_pixel_vectors)
+
+    _rotated_pixels = Event._rotated_pixels
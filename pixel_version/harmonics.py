@@ -0,0 +1,122 @@
+"""Real spherical harmonics and their rotation matrices.
+
+Real harmonics without the Condon-Shortley phase,
+
+    Y_lm = sqrt(2) N_lm P_l^m(cos theta) cos(m phi)      m > 0
+    Y_l0 = N_l0 P_l(cos theta)
+    Y_lm = sqrt(2) N_l|m| P_l^|m|(cos theta) sin(|m| phi) m < 0
+
+are orthonormal on the sphere, and Y_1,-1, Y_10, Y_11 are proportional to
+y, z and x. Coefficients are stored flat, (l, m) at index l**2 + l + m.
+
+Under a rotation the harmonics of each degree mix among themselves,
+Y_l(R n) = D^l(R) Y_l(n). The real matrices D^l are built by the
+recursion of Ivanic & Ruedenberg (J. Phys. Chem. 1996, 100, 6342; and
+the 1998 correction) from D^1, which is R itself in the (y, z, x) order.
+"""
+import numpy as np
+
+
+def index(l, m):
+    """Flat index of the coefficient (l, m)"""
+    return l**2 + l + m
+
+
+def degrees(lmax):
+    """Degree l and order m of each flat index up to lmax"""
+    l = np.concatenate([np.full(2 * l + 1, l) for l in range(lmax + 1)])
+    m = np.concatenate([np.arange(-l, l + 1) for l in range(lmax + 1)])
+    return l, m
+
+
+def _legendre(lmax, x):
+    """Normalised associated Legendre functions N_lm P_l^m(x), without the
+    Condon-Shortley phase, as {(l, m): array} for 0 <= m <= l <= lmax"""
+    x = np.asarray(x, dtype=np.float64)
+    s = np.sqrt(np.clip(1 - x**2, 0, None))
+    p = {(0, 0): np.full(x.shape, np.sqrt(1 / (4 * np.pi)))}
+    for m in range(1, lmax + 1):
+        p[m, m] = np.sqrt((2 * m + 1) / (2 * m)) * s * p[m - 1, m - 1]
+    for m in range(lmax):
+        p[m + 1, m] = np.sqrt(2 * m + 3) * x * p[m, m]
+        for l in range(m + 2, lmax + 1):
+            a = np.sqrt((4 * l**2 - 1) / (l**2 - m**2))
+            b = np.sqrt(((l - 1)**2 - m**2) / (4 * (l - 1)**2 - 1))
+            p[l, m] = a * (x * p[l - 1, m] - b * p[l - 2, m])
+    return p
+
+
+def real_sph_harm(lmax, vectors):
+    """Real spherical harmonics up to lmax at unit vectors
+
+    Parameters
+    ----------
+        lmax: int
+            Maximum degree
+        vectors: np.array (3, n)
+            Unit vectors
+
+    Returns
+    -------
+        np.array (n, (lmax + 1)**2)
+    """
+    x, y, z = np.asarray(vectors, dtype=np.float64)
+    phi = np.arctan2(y, x)
+    p = _legendre(lmax, z)
+    Y = np.empty((len(z), (lmax + 1)**2))
+    for l in range(lmax + 1):
+        Y[:, index(l, 0)] = p[l, 0]
+        for m in range(1, l + 1):
+            Y[:, index(l, m)] = np.sqrt(2) * p[l, m] * np.cos(m * phi)
+            Y[:, index(l, -m)] = np.sqrt(2) * p[l, m] * np.sin(m * phi)
+    return Y
+
+
+def _p(i, l, a, b, R1, prev):
+    """Term P of the recursion for arrays of orders a, b. R1 and prev are
+    indexed from their lowest order, -1 and -(l - 1)"""
+    a = np.clip(a, -(l - 1), l - 1) + l - 1
+    inner = prev[a, np.clip(b, -(l - 1), l - 1) + l - 1]
+    top = R1[i + 1, 2] * prev[a, 2 * l - 2] - R1[i + 1, 0] * prev[a, 0]
+    bottom = R1[i + 1, 2] * prev[a, 0] + R1[i + 1, 0] * prev[a, 2 * l - 2]
+    return np.where(b == l, top, np.where(b == -l, bottom, R1[i + 1, 1] * inner))
+
+
+def wigner_d_real(lmax, rotmat):
+    """Real rotation matrices of the harmonics up to lmax
+
+    Parameters
+    ----------
+        lmax: int
+            Maximum degree
+        rotmat: np.array (3, 3)
+            Rotation matrix
+
+    Returns
+    -------
+        list of np.array (2l + 1, 2l + 1), D^l with Y_l(R n) = D^l Y_l(n)
+    """
+    order = [1, 2, 0] # y, z, x
+    R1 = np.asarray(rotmat, dtype=np.float64)[np.ix_(order, order)]
+    D = [np.ones((1, 1)), R1]
+    for l in range(2, lmax + 1):
+        m, n = np.meshgrid(np.arange(-l, l + 1), np.arange(-l, l + 1),
+                           indexing='ij')
+        am = np.abs(m)
+        d = (m == 0).astype(float)
+        denom = np.where(np.abs(n) < l, (l + n) * (l - n), 2 * l * (2 * l - 1))
+        u = np.sqrt((l + m) * (l - m) / denom)
+        v = 0.5 * np.sqrt((1 + d) * (l + am - 1) * (l + am) / denom) * (1 - 2 * d)
+        w = -0.5 * np.sqrt(np.clip((l - am - 1) * (l - am), 0, None) / denom) * (1 - d)
+        prev = D[l - 1]
+        P = lambda i, a, b: _p(i, l, a, b, R1, prev)
+        U = P(0, m, n)
+        one = (np.abs(m) == 1).astype(float)
+        V = np.where(m == 0, P(1, 1, n) + P(-1, -1, n),
+            np.where(m > 0,
+                     P(1, m - 1, n) * np.sqrt(1 + one) - P(-1, -m + 1, n) * (1 - one),
+                     P(1, m + 1, n) * (1 - one) + P(-1, -m - 1, n) * np.sqrt(1 + one)))
+        W = np.where(m > 0, P(1, m + 1, n) + P(-1, -m - 1, n),
+                     P(1, m - 1, n) - P(-1, -m + 1, n))
+        D.append(u * U + v * V + w * W)
+    return D[:lmax + 1]
@@ -1,12 +1,9 @@
 import numpy as np
-import healpy as hp
-from scipy import special as sp
-import shutil
 import os
+import time
+import argparse
 from pathlib import Path
-import matplotlib.pyplot as plt
 
-from detections import Event, Run
 from setup import events_list, runs_list
 from model import IsotropicModel, NumericalIsotropicModel
 
@@ -17,65 +14,57 @@ folder = os.path.basename(path)
 parent = path.replace(folder,"") # parent directory of all scripts
 # parent = '/home/2311453s/BH-Iso/pixel_version' # can set manually if needed
 
+parser = argparse.ArgumentParser(description='Isotropic rate posterior')
+parser.add_argument('--check', action='store_true',
+                    help='compare with the numerical solution of the pixel model')
+args = parser.parse_args()
+
 events = events_list()
 runs = runs_list()
 
-"""Numerical Isotropic Solution"""
-num_model = NumericalIsotropicModel(events, runs) # read in isotropic model
-R_bounds = (1e-5,750)                             # define upper and lower bounds of the Rate R
+"""Isotropic Solution"""
+start = time.time()
+R_bounds = (1e-5,750)                                 # define upper and lower bounds of the Rate R
+iso_model = IsotropicModel(events, runs, rate_bounds=R_bounds) # constants computed once here
 R = np.linspace(R_bounds[0],R_bounds[1],5000)
-dR = R[1] - R[0]
+a0 = R / (4*np.pi)                                    # factor of 4pi given by R = 4pi * a0
 
-result = num_model.maximum_logpost                # generate and save the maximum log posterior
-x = result[0]
-x = x.tolist()
-log_y = result[1]
-#log_y.tolist()
-x_y = list(zip(x,log_y))
-max_logpost = result[2]
+x, log_y, max_logpost = iso_model.maximum_logpost()   # log posterior on a grid and its maximum
 print(max_logpost)
 
-output = 'iso_result/'               
-out_file ='iso_max_logpost.txt'
-output_ = Path(output,sep ='\t')
-output_.mkdir(parents=True, exist_ok=True)
-np.savetxt(os.path.join(parent , output + out_file), x_y)
+log_post = iso_model.log_posterior(a0)
+evidence = iso_model.log_evidence()                   # closed form over R_bounds, the rate prior of the pixel Model
+post_norm = np.exp(log_post - evidence) / (4*np.pi)   # normalised density in R
+print("log_evidence over R in ({}, {}) = ".format(*R_bounds), evidence)
+print("isotropic analysis in {:.2f} ms".format(1e3 * (time.time() - start)))
 
-log_post = [num_model.log_posterior(i / (4*np.pi)) for i in R] # factor of 4pi given by R = 4pi * a0
-shft_Post = log_post - min(log_post) - 2000 # shift by the (absolute) max to get values of log_post within (-745,709)
-res = np.where(shft_Post < 0 , 0, shft_Post) # replace values outside of max - 2000 range with 0, don't care about being more accurate
-post = [np.exp(i) for i in shft_Post] 
-post_corrected = np.nan_to_num(post,0) # remove exp(0) and replace with 0
-dR = isoR[1] - isoR[0]
-post_Area = np.sum([dR * i for i in post_corrected]) # calculate the area by approximating as a histogram
-post_norm = [i  / post_Area for i in post_corrected] # normalise
-norm_area = np.sum([dR * i for i in post_norm]) # test line, this should be equal to 1 for it be properly normalised
+output = 'iso_result/'
+output_ = Path(parent, output)
+output_.mkdir(parents=True, exist_ok=True)
+np.savetxt(os.path.join(parent , output + 'iso_max_logpost.txt'), np.column_stack([x, log_y]))
 
-    if norm_area = 1.0:
-        pass
-    else:
-        raise Exception("Not properly normalised, check the normalisation area and input data")
-        
 post_header = "Rate \t log_posterior \t normalised posterior"
-path = os.path.join(parent , 'iso_result/post.txt')
-data = list(zip(R,list(log_post_shft),list(post_norm)))
-np.savetxt(path, data,header = post_header,fmt='%.8e')
+data = np.column_stack([R, log_post, post_norm])
+np.savetxt(os.path.join(parent , output + 'post.txt'), data, header = post_header, fmt='%.8e')
 
 evidence_header = "log_evidence"
-evidence,log_post = num_model.log_evidence # calls on log_evidence from model.py
-print("log_evidence = ", evidence)
-
-o = open(os.path.join(parent , 'iso_result/iso_evidence.txt'),'w')
+o = open(os.path.join(parent , output + 'iso_evidence.txt'),'w')
 print(evidence_header,evidence,sep = '\n', file=o)
 o.close()
 
-
-"""Isotropic Solution"""
-iso_model = IsotropicModel(events, runs)
-
 header = ("alpha","beta")
 result = (iso_model.alpha_const,iso_model.beta_const)
-
-o = open(os.path.join(parent , 'iso_result/iso.txt'),'w')
+o = open(os.path.join(parent , output + 'iso.txt'),'w')
 print(header,result,sep = '\n', file=o)
-o.close()
\ No newline at end of file
+o.close()
+
+"""Numerical Isotropic Solution"""
+if args.check:
+    num_model = NumericalIsotropicModel(events, runs)
+    diff = np.max(np.abs(num_model.log_posterior(a0) - log_post))
+    print("max |log_posterior difference| = ", diff)
+    num_evidence, _ = num_model.log_evidence
+    grid = np.linspace(1e-5, 200, 20000)              # grid of NumericalIsotropicModel.log_evidence
+    print("log_evidence numerical = ", num_evidence,
+          ", same grid = ", iso_model.log_evidence(grid=grid),
+          ", closed form = ", iso_model.log_evidence(bounds=(1e-5, 200)))
@@ -1,4 +1,6 @@
 """Posterior model for detecting BBH signals isotropy"""
+import hashlib
+
 import numpy as np
 from scipy.integrate import quad
 from scipy import special as sp
@@ -6,6 +8,49 @@ import healpy as hp
 
 from transforms3d.euler import euler2mat
 
+from sharedarrays import SharedArrays
+import harmonics
+
+
+def _axis_rotations(axis, angles):
+    """Stacked rotation matrices by angles about the x, y or z axis"""
+    i = 'xyz'.index(axis)
+    j, k = (i + 1) % 3, (i + 2) % 3
+    c, s = np.cos(angles), np.sin(angles)
+    R = np.zeros((len(angles), 3, 3))
+    R[:, i, i] = 1
+    R[:, j, j] = c
+    R[:, k, k] = c
+    R[:, k, j] = s
+    R[:, j, k] = -s
+    return R
+
+
+def euler2mat_batch(ai, aj, ak, axes='rzyz'):
+    """Vectorised transforms3d.euler.euler2mat
+
+    Parameters
+    ----------
+        ai, aj, ak: np.array
+            First, second and third Euler angles of each rotation
+        axes: str (default 'rzyz')
+            Order of Euler rotations, as in transforms3d
+
+    Returns
+    -------
+        np.array (n, 3, 3)
+    """
+    ai, aj, ak = [np.atleast_1d(np.asarray(a, dtype=np.float64))
+                  for a in (ai, aj, ak)]
+    frame, order = axes[0], axes[1:]
+    R = [_axis_rotations(axis, a) for axis, a in zip(order, (ai, aj, ak))]
+    if frame == 'r':
+        # rotating axes, the first rotation is outermost
+        return R[0] @ R[1] @ R[2]
+    elif frame == 's':
+        return R[2] @ R[1] @ R[0]
+    raise ValueError('unknown axes {}'.format(axes))
+
 class Model(object):
     """Posterior model for the aniso pixel version of BBH isotropy code.
 
@@ -23,15 +68,21 @@ class Model(object):
             Min and max rate
         axes: str (default 'rzyz')
             Order of Euler rotations
+        rotation_cache: rotcache.RotationCache (default None)
+            If given, rotations are snapped to its grid and the rotated
+            pixel indices are reused between calls
     """
     def __init__(self, events, runs, weights_nside,
-                 rate_bounds=(1e-5, 750), axes='rzyz'):
+                 rate_bounds=(1e-5, 750), axes='rzyz', rotation_cache=None):
         # store inputs
         self.runs = runs
         self.events = events
         self._weights_nside = weights_nside
         self.rate_bounds = rate_bounds
         self._axes = axes
+        if rotation_cache is not None and rotation_cache._axes != axes:
+            raise ValueError('the rotation cache must use the same axes')
+        self.rotation_cache = rotation_cache
 
         self._nside = events[0]._nside # nside of the pofd maps
         # observing volume
@@ -49,90 +100,605 @@ class Model(object):
                                 np.arange(hp.nside2npix(weights_nside)))
         self._weight_pixs_centres = np.array(self._weight_pixs_centres)
 
+        # posterior samples of all events stacked into contiguous arrays,
+        # with _event_index the event owning each column
+        counts = np.array([event._sky_vectors.shape[1] for event in events])
+        self._n_events = len(events)
+        self._event_counts = counts
+        self._event_index = np.repeat(np.arange(len(events)), counts)
+        self._sky_vectors = np.ascontiguousarray(
+            np.hstack([event._sky_vectors for event in events]))
+        self._sample_factors = np.concatenate(
+            [event._pdist * event._pmass for event in events])
+
+        # nexp is linear in the run maps, so they are combined once into
+        # a single VT weighted exposure map
+        if any(run._nside != self._nside for run in runs):
+            raise ValueError('the pofd maps of the runs and events must '
+                             'share the same nside')
+        self._exposure = np.sum([self._volume * run.observing_time
+                                 * np.asarray(run.pofd) for run in runs], axis=0)
+        self._pixel_vectors = np.array(events[0]._pofd_pixel_vectors)
+        # sufficient statistics of the last two rotations, so that going
+        # back to the current one after a rejected proposal is free
+        self._stats_memo = []
+        self._shared = None
+
+    # read-only arrays that share_memory moves into shared memory
+    _shared_names = ['_weights_cents', '_weight_pixs_centres', '_event_counts',
+                     '_event_index', '_sky_vectors', '_sample_factors',
+                     '_exposure', '_pixel_vectors']
+
+    def share_memory(self):
+        """Moves the arrays used by the likelihood into shared memory.
+        Pickled copies of the model, as sent to worker processes, then
+        attach to the same segments instead of carrying the arrays, and
+        leave out the events and runs, which the likelihood does not use.
+        """
+        if self._shared is None:
+            self._shared = SharedArrays()
+            for name in self._shared_names:
+                setattr(self, name, self._shared.share(name, getattr(self, name)))
+        return self
+
+    def fingerprint(self):
+        """JSON serialisable description of what the likelihood is built
+        from: the events, runs, nsides and a hash of the arrays"""
+        digest = hashlib.sha1()
+        for name in self._shared_names:
+            digest.update(np.ascontiguousarray(getattr(self, name)).tobytes())
+        return {'events': [getattr(e, 'name', None) for e in self.events],
+                'runs': [getattr(r, 'name', None) for r in self.runs],
+                'weights_nside': self._weights_nside, 'nside': self._nside,
+                'rate_bounds': list(self.rate_bounds), 'axes': self._axes,
+                'data': digest.hexdigest()}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_stats_memo'] = []
+        if self._shared is not None:
+            for name in self._shared_names:
+                del state[name]
+            state['events'] = state['runs'] = None
+            if self.rotation_cache is not None:
+                # each worker fills its own cache
+                state['rotation_cache'] = self.rotation_cache.empty_copy()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._shared is not None:
+            for name in self._shared_names:
+                setattr(self, name, self._shared[name])
+
     def _change_basis(self, weights):
         """Switches dimensions of a healpy map. Here used to render the
         12 pixel weights on a higher dimensional basis.
         """
         return weights[self._weights_cents]
 
+    def rotation(self, pars):
+        """Rotation matrix of the Euler angles in pars, snapped to the grid
+        of the rotation cache if there is one."""
+        if self.rotation_cache is not None:
+            return self.rotation_cache.rotation(pars['a'], pars['cosb'],
+                                                pars['c'])
+        return euler2mat(pars['a'], np.arccos(pars['cosb']), pars['c'],
+                         axes=self._axes)
+
+    def _lookup(self, rotmat, name, func):
+        """func(rotmat), through the rotation cache if there is one"""
+        if self.rotation_cache is None:
+            return func(rotmat)
+        return self.rotation_cache.lookup(rotmat, name, func)
+
+    def _rotated_weight_pixels(self, rotmat):
+        """Weight pixels of the rotated weight pixel centres"""
+        rot_vecs = hp.rotator.rotateVector(rotmat, self._weight_pixs_centres)
+        return hp.vec2pix(self._weights_nside, rot_vecs[0, :],
+                          rot_vecs[1, :], rot_vecs[2, :])
+
+    def _rotated_pixels(self, rotmat):
+        """Pixels of the pofd maps that rotate onto each pixel centre"""
+        old_centres = np.matmul(rotmat.T, self._pixel_vectors)
+        return hp.vec2pix(self._nside, old_centres[0, :], old_centres[1, :],
+                          old_centres[2, :]).astype(np.int32)
+
+    def _sample_pixels(self, rotmat):
+        """Pofd map pixels of the rotated posterior samples of all events"""
+        vects = np.matmul(rotmat, self._sky_vectors)
+        return hp.vec2pix(self._nside, vects[0, :], vects[1, :],
+                          vects[2, :]).astype(np.int32)
+
     def logprior_rotation(self, rotmat):
         """Checks whether any original pixel weight gets rotated beyond
         its original boundaries.
         """
         # Rotate pixel centres and test if all remain in the original pixel
-        rot_vecs = hp.rotator.rotateVector(rotmat, self._weight_pixs_centres)
-        rot_pixs = hp.vec2pix(self._weights_nside, rot_vecs[0, :],
-                              rot_vecs[1, :], rot_vecs[2, :])
-        if not np.alltrue(rot_pixs == self._weight_pix_order):
-            return -np.infty
+        rot_pixs = self._lookup(rotmat, ('weight_pixels', self._weights_nside),
+                                self._rotated_weight_pixels)
+        if not np.all(rot_pixs == self._weight_pix_order):
+            return -np.inf
         return 0.0
 
     def logprior_rate(self, weights):
         """Log prior on the astrophysical rate."""
         if np.any(weights < 0):
-            return -np.infty
+            return -np.inf
         N = len(weights)
         R = np.sum(weights) * 4 * np.pi / N
         if not self.rate_bounds[0] < R < self.rate_bounds[1]:
-            return -np.infty
+            return -np.inf
         return - (N - 0.5) * np.log(R)
 
+    def statistics(self, rotmat):
+        """Sufficient statistics of the likelihood at a given rotation.
+        The weights are constant over each weight pixel, so for weights w
+        nexp = E @ w and each event's probability is (S @ w)[event].
+        Kept for the last two rotations, so changing only the weights is cheap.
+        ---------------------
+        Parameters:
+            rotmat: np.array (3,3)
+                Rotation matrix
+        ---------------------
+        Returns:
+            S: np.array (events, weight pixels)
+                Mean of _pdist * _pmass over the posterior samples of each
+                event, restricted to those rotated into each weight pixel
+            E: np.array (weight pixels,)
+                VT weighted exposure over each weight pixel
+        """
+        for memo_rotmat, stats in self._stats_memo:
+            if np.array_equal(rotmat, memo_rotmat):
+                return stats
+        K = len(self.weight_pars)
+        # find in which pixel the rotated posterior samples now are
+        npix = self._lookup(rotmat, ('samples', id(self)), self._sample_pixels)
+        cells = self._event_index * K + self._weights_cents[npix]
+        S = np.bincount(cells, self._sample_factors, minlength=self._n_events * K)
+        S = S.reshape((self._n_events, K)) / self._event_counts[:, None]
+        # pixels of the exposure map that rotate onto each pixel centre
+        old_order = self._lookup(rotmat, ('pixels', self._nside),
+                                 self._rotated_pixels)
+        dOmega = 4 * np.pi / len(old_order)
+        E = np.bincount(self._weights_cents, self._exposure[old_order],
+                        minlength=K) * dOmega
+        self._stats_memo = [(np.array(rotmat), (S, E))] + self._stats_memo[:1]
+        return S, E
+
     def nexp(self, rotmat, weights):
-        """Expected number of detections over the observing time."""
-        nexp = 0
-        dOmega = 4 * np.pi / len(weights)
-        for run in self.runs:
-            pofd = run.rotate_pofd(rotmat)
-            VT = self._volume * run.observing_time
-            nexp += VT * np.sum(weights * pofd) * dOmega
-        return nexp
+        """Expected number of detections over the observing time, for the
+        weights of the weight pixels."""
+        return np.dot(self.statistics(rotmat)[1], weights)
 
     def logprob_detections(self, rotmat, weights):
         """Detections likelihood, gives the product of expected number of
         detections at the detection time and likelihood of the posterior
-        samples.
+        samples, for the weights of the weight pixels.
         """
-        logprob = 0.0
-        for event in self.events:
-            pofd = event.rotate_pofd(rotmat)
-            # rotated sky vectors of the posterior samples
-            vects = event.rotate_sky_samples(rotmat)
-            # find in which pixel the rotated vectors now are
-            npix = hp.vec2pix(self._nside, vects[0, :], vects[1, :],
-                              vects[2, :])
-            num = np.mean(weights[npix] * event._pdist * event._pmass)
-            logprob += np.log(num)
-        return logprob
+        return np.sum(np.log(np.matmul(self.statistics(rotmat)[0], weights)))
+
+    def grad_loglikelihood(self, rotmat, weights):
+        """Gradient of the log likelihood with respect to the weights at a
+        fixed rotation, -E + S^T (1 / (S w))"""
+        S, E = self.statistics(rotmat)
+        return - E + np.matmul(1 / np.matmul(S, weights), S)
+
+    def hvp_loglikelihood(self, rotmat, weights, vector):
+        """Hessian of the log likelihood with respect to the weights at a
+        fixed rotation times vector, -S^T ((S v) / (S w)**2)"""
+        S, _ = self.statistics(rotmat)
+        rates = np.matmul(S, weights)
+        return - np.matmul(np.matmul(S, vector) / rates**2, S)
+
+    def grad_logprior_rate(self, weights):
+        """Gradient of logprior_rate where it is finite"""
+        N = len(weights)
+        return np.full(N, - (N - 0.5) / np.sum(weights))
+
+    def hvp_logprior_rate(self, weights, vector):
+        """Hessian of logprior_rate times vector, where it is finite"""
+        N = len(weights)
+        return np.full(N, (N - 0.5) * np.sum(vector) / np.sum(weights)**2)
 
     def logprior(self, pars):
         """Log prior."""
         # check rotations
-        rotmat = euler2mat(pars['a'], np.arccos(pars['cosb']), pars['c'],
-                           axes=self._axes)
+        rotmat = self.rotation(pars)
         if not np.isfinite(self.logprior_rotation(rotmat)):
-            return -np.infty
+            return -np.inf
         # calc rate prior
         weights = np.array([pars[p] for p in self.weight_pars])
         lp = self.logprior_rate(weights)
         if not np.isfinite(lp):
-            return -np.infty
-        print(lp)
+            return -np.inf
         return lp
 
     def loglikelihood(self, pars):
         """Log likelihood."""
         weights = np.array([pars[p] for p in self.weight_pars])
-        rotmat = euler2mat(pars['a'], np.arccos(pars['cosb']), pars['c'],
-                           axes=self._axes)
-        #recast the weights into a higher dimensional basis matching pofd map
-        weights = self._change_basis(weights)
+        rotmat = self.rotation(pars)
         Nexp = self.nexp(rotmat, weights)
         return - Nexp + self.logprob_detections(rotmat, weights)
 
+    @property
+    def param_names(self):
+        """Column order of the points of the batch methods"""
+        return self.weight_pars + self.rot_pars
+
+    def _split_points(self, points):
+        """Weights (n, K) and Euler angles of an (n, parameters) array"""
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+        K = len(self.weight_pars)
+        if points.shape[1] != K + len(self.rot_pars):
+            raise ValueError('points must have columns {}'.format(
+                self.param_names))
+        a, cosb, c = points[:, K], points[:, K + 1], points[:, K + 2]
+        return points[:, :K], a, cosb, c
+
+    def rotations(self, a, cosb, c):
+        """Stacked rotation matrices of arrays of Euler angles"""
+        return euler2mat_batch(a, np.arccos(cosb), c, axes=self._axes)
+
+    def logprior_batch(self, points):
+        """Log prior of many points at once.
+
+        Parameters
+        ----------
+            points: np.array (n, parameters)
+                Columns ordered as param_names
+
+        Returns
+        -------
+            np.array (n,)
+        """
+        weights, a, cosb, c = self._split_points(points)
+        lp = np.zeros(len(weights))
+        # rotation must keep every weight pixel centre in its pixel
+        valid = np.abs(cosb) <= 1
+        if self.rotation_cache is not None:
+            # the rotations the likelihood uses, as in logprior
+            rotmats = np.array([self.rotation_cache.rotation(*angles)
+                                for angles in zip(a, cosb, c)])
+        else:
+            rotmats = self.rotations(a, np.clip(cosb, -1, 1), c)
+        rot_vecs = np.matmul(rotmats, self._weight_pixs_centres)
+        rot_pixs = hp.vec2pix(self._weights_nside, rot_vecs[:, 0, :],
+                              rot_vecs[:, 1, :], rot_vecs[:, 2, :])
+        valid &= np.all(rot_pixs == self._weight_pix_order, axis=1)
+        # rate prior
+        N = weights.shape[1]
+        R = np.sum(weights, axis=1) * 4 * np.pi / N
+        valid &= np.all(weights >= 0, axis=1)
+        valid &= (self.rate_bounds[0] < R) & (R < self.rate_bounds[1])
+        lp[valid] = - (N - 0.5) * np.log(R[valid])
+        lp[~valid] = -np.inf
+        return lp
+
+    def statistics_batch(self, rotmats, block=2**18):
+        """statistics() of stacked rotation matrices, (n, events, K) and
+        (n, K). The rotated samples are held for as many rotations at a
+        time as fit in block pixel indices."""
+        n, K, nev = len(rotmats), len(self.weight_pars), self._n_events
+        S = np.empty((n, nev, K))
+        E = np.empty((n, K))
+        step = max(1, block // max(self._sky_vectors.shape[1],
+                                   self._pixel_vectors.shape[1]))
+        for start in range(0, n, step):
+            R = rotmats[start:start + step]
+            m = len(R)
+            offsets = np.arange(m)[:, None]
+            vects = np.matmul(R, self._sky_vectors)
+            npix = hp.vec2pix(self._nside, vects[:, 0, :], vects[:, 1, :],
+                              vects[:, 2, :])
+            cells = (offsets * nev + self._event_index) * K \
+                + self._weights_cents[npix]
+            counts = np.bincount(cells.ravel(),
+                                 np.tile(self._sample_factors, m),
+                                 minlength=m * nev * K)
+            S[start:start + m] = counts.reshape((m, nev, K)) \
+                / self._event_counts[:, None]
+            old_centres = np.matmul(np.transpose(R, (0, 2, 1)),
+                                    self._pixel_vectors)
+            old_order = hp.vec2pix(self._nside, old_centres[:, 0, :],
+                                   old_centres[:, 1, :], old_centres[:, 2, :])
+            dOmega = 4 * np.pi / old_order.shape[1]
+            exposure = np.bincount(
+                (offsets * K + self._weights_cents).ravel(),
+                self._exposure[old_order].ravel(), minlength=m * K)
+            E[start:start + m] = exposure.reshape((m, K)) * dOmega
+        return S, E
+
+    def loglikelihood_batch(self, points):
+        """Log likelihood of many points at once.
+
+        Parameters
+        ----------
+            points: np.array (n, parameters)
+                Columns ordered as param_names
+
+        Returns
+        -------
+            np.array (n,)
+        """
+        weights, a, cosb, c = self._split_points(points)
+        if self.rotation_cache is not None:
+            # snapped rotations reuse the cached pixel indices one by one
+            rotmats = [self.rotation_cache.rotation(*angles)
+                       for angles in zip(a, cosb, c)]
+            stats = [self.statistics(rotmat) for rotmat in rotmats]
+            S = np.array([s for s, _ in stats])
+            E = np.array([e for _, e in stats])
+        else:
+            # points differing only in their weights share the statistics
+            angles, inverse = np.unique(np.column_stack([a, cosb, c]),
+                                        axis=0, return_inverse=True)
+            S, E = self.statistics_batch(self.rotations(*angles.T))
+            inverse = inverse.ravel()
+            S, E = S[inverse], E[inverse]
+        Nexp = np.einsum('nk,nk->n', E, weights)
+        return - Nexp + np.sum(np.log(np.einsum('nek,nk->ne', S, weights)),
+                               axis=1)
+
+
+class HarmonicModel(object):
+    """Anisotropic model with the rate density expanded in real spherical
+    harmonics up to lmax, r(n) = sum_lm c_lm Y_lm(n), in events per
+    steradian, so that the rate is R = sqrt(4 pi) c_00.
+
+    The posterior samples and the exposure map are projected on the
+    harmonics once. A rotation then acts on the coefficients through the
+    real Wigner-D matrices, so the likelihood costs O(lmax**3) plus a
+    product with the (events x coefficients) matrix, whatever the number
+    of samples and pixels. Rotations need no rejection step; with all
+    the orders they only re-parameterise the coefficients, so they are
+    mostly of use with axisymmetric=True, where they orient the pattern.
+
+    Parameters
+    ----------
+        events: list
+            List of detection.Event objects
+        runs: list
+            List of detection.Run objects
+        lmax: int
+            Maximum degree of the expansion
+        rate_bounds: length-2 tuple (default (1e-5, 750))
+            Min and max rate
+        axes: str (default 'rzyz')
+            Order of Euler rotations
+        axisymmetric: bool (default False)
+            Only use the m = 0 coefficients
+        positivity_nside: int (default None)
+            nside of the grid on which the rate density is required to be
+            non-negative, by default the smallest power of 2 above 2 lmax
+    """
+    def __init__(self, events, runs, lmax, rate_bounds=(1e-5, 750),
+                 axes='rzyz', axisymmetric=False, positivity_nside=None):
+        self.runs = runs
+        self.events = events
+        self.lmax = lmax
+        self.rate_bounds = rate_bounds
+        self._axes = axes
+        self._nside = events[0]._nside
+        self._volume = 4 / 3 * np.pi * (events[0]._dlmax*1e-3)**3
+
+        l, m = harmonics.degrees(lmax)
+        # coefficients that are parameters
+        self._free = np.where(m == 0)[0] if axisymmetric else np.arange(len(l))
+        self.coeff_pars = ['c{}_{}'.format(l[i], m[i]) for i in self._free]
+        self.rot_pars = ['a', 'cosb', 'c']
+        # harmonic coefficients of the samples of each event,
+        # mean of _pdist * _pmass * Y_lm over the samples
+        self._event_coeffs = np.array([
+            np.matmul(event._pdist * event._pmass,
+                      harmonics.real_sph_harm(lmax, event._sky_vectors))
+            / event._sky_vectors.shape[1] for event in events])
+        # and of the VT weighted exposure map, integrated over the sky
+        if any(run._nside != self._nside for run in runs):
+            raise ValueError('the pofd maps of the runs and events must '
+                             'share the same nside')
+        exposure = np.sum([self._volume * run.observing_time
+                           * np.asarray(run.pofd) for run in runs], axis=0)
+        Y = harmonics.real_sph_harm(
+            lmax, np.array(events[0]._pofd_pixel_vectors))
+        self._exposure_coeffs = np.matmul(exposure, Y) * 4 * np.pi / len(exposure)
+        # positivity grid
+        if positivity_nside is None:
+            positivity_nside = 2**int(np.ceil(np.log2(max(2 * lmax, 1))))
+        self._grid_harmonics = harmonics.real_sph_harm(
+            lmax, np.array(hp.pix2vec(positivity_nside,
+                                      np.arange(hp.nside2npix(positivity_nside)))))
+        self._grid_harmonics = self._grid_harmonics[:, self._free]
+
+    @property
+    def param_names(self):
+        """Column order of the points of the batch methods"""
+        return self.coeff_pars + self.rot_pars
+
+    def share_memory(self):
+        """Nothing to share, the likelihood only uses the small coefficient
+        arrays. Pickled copies still leave out the events and runs."""
+        return self
+
+    def fingerprint(self):
+        """JSON serialisable description of what the likelihood is built
+        from, as Model.fingerprint"""
+        digest = hashlib.sha1()
+        for array in [self._event_coeffs, self._exposure_coeffs,
+                      self._grid_harmonics]:
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return {'events': [getattr(e, 'name', None) for e in self.events],
+                'runs': [getattr(r, 'name', None) for r in self.runs],
+                'lmax': self.lmax, 'coefficients': self.coeff_pars,
+                'nside': self._nside, 'rate_bounds': list(self.rate_bounds),
+                'axes': self._axes, 'data': digest.hexdigest()}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['events'] = state['runs'] = None
+        return state
+
+    def coefficients(self, pars):
+        """All the (lmax + 1)**2 coefficients from pars, zero for the
+        orders that are not parameters"""
+        coeffs = np.zeros((self.lmax + 1)**2)
+        coeffs[self._free] = [pars[p] for p in self.coeff_pars]
+        return coeffs
+
+    def rotation(self, pars):
+        return euler2mat(pars['a'], np.arccos(pars['cosb']), pars['c'],
+                         axes=self._axes)
+
+    def shape_bounds(self):
+        """Range of each free coefficient but c0_0 divided by c0_0 over the
+        densities that are non-negative on the positivity grid, from one
+        linear program per bound
+
+        Returns
+        -------
+            np.array (free coefficients - 1, 2)
+        """
+        from scipy.optimize import linprog
+        G = self._grid_harmonics
+        bounds = np.empty((G.shape[1] - 1, 2))
+        for j in range(G.shape[1] - 1):
+            for k, sign in enumerate([1, -1]):
+                cost = np.zeros(G.shape[1] - 1)
+                cost[j] = sign
+                # G[:, 1:] s >= -G[:, 0], with c0_0 = 1
+                res = linprog(cost, A_ub=-G[:, 1:], b_ub=G[:, 0],
+                              bounds=(None, None))
+                bounds[j, k] = sign * res.fun
+        return bounds
+
+    def rotate(self, rotmat, coeffs):
+        """Coefficients of the rotated density, r_R(n) = r(R n), that the
+        pixel Model evaluates at the data directions"""
+        D = harmonics.wigner_d_real(self.lmax, rotmat)
+        out = np.empty_like(coeffs)
+        for l in range(self.lmax + 1):
+            block = slice(l**2, (l + 1)**2)
+            out[block] = np.matmul(coeffs[block], D[l])
+        return out
+
+    def density(self, coeffs, vectors):
+        """Rate density at unit vectors (3, n)"""
+        return np.matmul(harmonics.real_sph_harm(self.lmax, vectors), coeffs)
+
+    def logprior_rate(self, coeffs):
+        """Log prior on the coefficients: the rate density must be
+        non-negative on the positivity grid, R within the rate bounds, and
+        p(c) ~ R**-(n - 0.5) for n free coefficients, i.e. Jeffreys in R and
+        uniform in the shape c / R, as for the pixel weights of Model."""
+        R = np.sqrt(4 * np.pi) * coeffs[0]
+        if not self.rate_bounds[0] < R < self.rate_bounds[1]:
+            return -np.inf
+        if np.min(np.matmul(self._grid_harmonics, coeffs[self._free])) < 0:
+            return -np.inf
+        return - (len(self._free) - 0.5) * np.log(R)
+
+    def logprior(self, pars):
+        """Log prior. Rotations are uniform within the sampler bounds."""
+        return self.logprior_rate(self.coefficients(pars))
+
+    def nexp(self, rotmat, coeffs):
+        """Expected number of detections over the observing time"""
+        return np.dot(self._exposure_coeffs, self.rotate(rotmat, coeffs))
+
+    def logprob_detections(self, rotmat, coeffs):
+        """Log of the product of the events' rate density averaged over
+        their posterior samples, -inf where it is not positive"""
+        rates = np.matmul(self._event_coeffs, self.rotate(rotmat, coeffs))
+        if np.any(rates <= 0):
+            return -np.inf
+        return np.sum(np.log(rates))
+
+    def loglikelihood(self, pars):
+        """Log likelihood."""
+        coeffs = self.coefficients(pars)
+        rotated = self.rotate(self.rotation(pars), coeffs)
+        rates = np.matmul(self._event_coeffs, rotated)
+        if np.any(rates <= 0):
+            return -np.inf
+        return - np.dot(self._exposure_coeffs, rotated) + np.sum(np.log(rates))
+
+    def _split_points(self, points):
+        """All the coefficients (n, (lmax + 1)**2) and Euler angles of an
+        (n, parameters) array"""
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+        K = len(self.coeff_pars)
+        if points.shape[1] != K + len(self.rot_pars):
+            raise ValueError('points must have columns {}'.format(
+                self.param_names))
+        coeffs = np.zeros((len(points), (self.lmax + 1)**2))
+        coeffs[:, self._free] = points[:, :K]
+        return coeffs, points[:, K], points[:, K + 1], points[:, K + 2]
+
+    def logprior_batch(self, points):
+        """Log prior of many points at once, as Model.logprior_batch
+
+        Parameters
+        ----------
+            points: np.array (n, parameters)
+                Columns ordered as param_names
+
+        Returns
+        -------
+            np.array (n,)
+        """
+        coeffs, a, cosb, c = self._split_points(points)
+        R = np.sqrt(4 * np.pi) * coeffs[:, 0]
+        valid = np.abs(cosb) <= 1
+        valid &= (self.rate_bounds[0] < R) & (R < self.rate_bounds[1])
+        valid &= np.min(np.matmul(coeffs[:, self._free],
+                                  self._grid_harmonics.T), axis=1) >= 0
+        lp = np.full(len(coeffs), -np.inf)
+        lp[valid] = - (len(self._free) - 0.5) * np.log(R[valid])
+        return lp
+
+    def loglikelihood_batch(self, points):
+        """Log likelihood of many points at once. The Wigner-D matrices
+        are built once per distinct rotation.
+
+        Parameters
+        ----------
+            points: np.array (n, parameters)
+                Columns ordered as param_names
+
+        Returns
+        -------
+            np.array (n,)
+        """
+        coeffs, a, cosb, c = self._split_points(points)
+        angles, inverse = np.unique(np.column_stack([a, cosb, c]), axis=0,
+                                    return_inverse=True)
+        inverse = inverse.ravel()
+        rotated = np.empty_like(coeffs)
+        for i, (ai, cosbi, ci) in enumerate(angles):
+            rows = inverse == i
+            D = harmonics.wigner_d_real(self.lmax, euler2mat(
+                ai, np.arccos(cosbi), ci, axes=self._axes))
+            for l in range(self.lmax + 1):
+                block = slice(l**2, (l + 1)**2)
+                rotated[rows, block] = np.matmul(coeffs[rows, block], D[l])
+        rates = np.matmul(rotated, self._event_coeffs.T)
+        logl = np.full(len(coeffs), -np.inf)
+        valid = np.all(rates > 0, axis=1)
+        logl[valid] = - np.matmul(rotated[valid], self._exposure_coeffs) \
+            + np.sum(np.log(rates[valid]), axis=1)
+        return logl
+
 
 class IsotropicModel(object):
     """Collection of constants for the posterior analytic isotropic model.
 
+    With all the pixel weights equal to a0 = R / (4 pi) and no rotation,
+    the likelihood of Model reduces to -alpha a0 + sum_e log(a0 c_e), with
+    alpha = alpha_const and c_e the mean of _pdist * _pmass over the
+    samples of event e. The constants are computed once, after which the
+    posterior, evidence and maximum are evaluated in closed form or on
+    any grid of a0 in one vectorised pass.
+
     -----------------------
     Parameters:
         events: list
@@ -151,7 +717,9 @@ class IsotropicModel(object):
         self.rate_bounds = rate_bounds
         # observing volume
         self._volume = 4 / 3 * np.pi * (events[0]._dlmax*1e-3)**3
-        # list of str that gives weight names
+        # constants of the likelihood
+        self._alpha = self.alpha_const
+        self._sum_log_c = np.sum(self.log_event_consts)
 
     @property
     def alpha_const(self):
@@ -170,16 +738,84 @@ class IsotropicModel(object):
             beta *= np.mean(event._pdist * event._pmass) / event.pofd.size
         return beta
 
+    @property
+    def log_event_consts(self):
+        """log c_e, mean of _pdist * _pmass over the samples of each event
+        """
+        return np.array([np.log(np.mean(event._pdist * event._pmass))
+                         for event in self.events])
+
+    @property
+    def a0_bounds(self):
+        """Bounds on a0 = R / (4 pi) from the rate bounds"""
+        return tuple(np.array(self.rate_bounds) / (4 * np.pi))
+
+    @staticmethod
+    def log_prior(a0):
+        """Jeffreys prior on the rate, as NumericalIsotropicModel"""
+        return -0.5 * np.log(4 * np.pi * np.asarray(a0, dtype=np.float64))
+
+    def log_likelihood(self, a0):
+        a0 = np.asarray(a0, dtype=np.float64)
+        return - self._alpha * a0 + len(self.events) * np.log(a0)\
+            + self._sum_log_c
+
+    def log_posterior(self, a0):
+        return self.log_prior(a0) + self.log_likelihood(a0)
+
+    def log_evidence(self, bounds=None, grid=None):
+        """Log evidence, the integral of the posterior over a0.
+
+        ---------------------
+        Parameters:
+            bounds: length-2 tuple (default a0_bounds)
+                Range of a0, integrated in closed form with the incomplete
+                gamma function
+            grid: np.array (default None)
+                If given, the trapezoid rule on this grid of a0 is used
+                instead
+        """
+        if grid is not None:
+            grid = np.asarray(grid, dtype=np.float64)
+            log_post = self.log_posterior(grid)
+            # trapezoid rule in log space
+            return sp.logsumexp(np.logaddexp(log_post[:-1], log_post[1:])
+                                + np.log(0.5 * np.diff(grid)))
+        lo, hi = self.a0_bounds if bounds is None else bounds
+        # int a0**(N - 1/2) exp(-alpha a0) da0 / sqrt(4 pi) * prod c_e
+        k = len(self.events) + 0.5
+        mass = sp.gammainc(k, self._alpha * hi) - sp.gammainc(k, self._alpha * lo)
+        return - 0.5 * np.log(4 * np.pi) + self._sum_log_c + sp.gammaln(k)\
+            - k * np.log(self._alpha) + np.log(mass)
+
+    @property
+    def maximum_a0(self):
+        """a0 of the maximum posterior, (N - 1/2) / alpha within the bounds"""
+        lo, hi = self.a0_bounds
+        return np.clip((len(self.events) - 0.5) / self._alpha, lo, hi)
+
+    def maximum_logpost(self, grid=None):
+        """Log posterior on a grid of a0 (default 1000 points within
+        a0_bounds). Returns the rates R = 4 pi a0 of the grid, the log
+        posterior and the rate of the maximum."""
+        if grid is None:
+            grid = np.linspace(*self.a0_bounds, 1000)
+        return 4 * np.pi * grid, self.log_posterior(grid),\
+            4 * np.pi * self.maximum_a0
+
 
 class NumericalIsotropicModel(object):
     """
     Numerical solution equivalent to ``IsotropicModel`` which is solved
     analytically. Imports the likelihood functions from the anisotropic
-    ``Model``.
+    ``Model``, whose statistics at the identity rotation are computed once
+    and broadcast over whole grids of a0.
     """
     def __init__(self, events, runs, rate_bounds=(1e-5, 200)):
         self.aniso_model = Model(events=events, runs=runs, weights_nside=1,
                                  rate_bounds=rate_bounds, axes='rzyz')
+        # statistics at the identity rotation, the only one used
+        self._S, self._E = self.aniso_model.statistics(np.eye(3))
 
     @staticmethod
     def _log_prior(a0): # a0 = R / 4 * pi 
@@ -188,9 +824,11 @@ class NumericalIsotropicModel(object):
         return log_prior
 
     def _log_likelihood(self, a0):
-        pars = {'a{}'.format(i): a0 for i in range(12)}
-        pars.update({'a': 0, 'cosb': 1, 'c': 0})
-        return self.aniso_model.loglikelihood(pars)
+        # all weights equal to a0 at the identity rotation: nexp = a0 sum(E)
+        # and the rate of each event is a0 times its row sum of S
+        a0 = np.asarray(a0, dtype=np.float64)
+        return - a0 * np.sum(self._E) + np.sum(
+            np.log(a0[..., None] * np.sum(self._S, axis=1)), axis=-1)
 
     def log_posterior(self, a0):
         log_post = self._log_prior(a0) + self._log_likelihood(a0)
@@ -207,24 +845,20 @@ class NumericalIsotropicModel(object):
         # evidence, std = quad(self._posterior, 1e-5, 200, epsabs=1e-200, epsrel=1e-200)
         # return np.log(evidence)
         grid = np.linspace(rate_bounds[0], rate_bounds[1], N)
-        delta_a = (rate_bounds[1]-rate_bounds[0])/N
-        log_post = [self.log_posterior(i) for i in grid]
-        log_evidence = sp.logsumexp(log_post)
-        # correction for endpoints
-        correction = sp.logsumexp([self.log_posterior(grid[0]), \
-            self.log_posterior(grid[-1])])
-        log_evidence = sp.logsumexp([log_evidence], b=[1,-0.5])
-        # log_evidence = sp.logsumexp([log_evidence, endvals], b=[1,-0.5])
+        delta_a = grid[1] - grid[0]
+        log_post = self.log_posterior(grid)
+        # trapezoid rule: sum of the values, half weight at the endpoints
+        weights = np.ones(N)
+        weights[[0, -1]] = 0.5
+        log_evidence = sp.logsumexp(log_post, b=weights)
         # correction for step size
         log_evidence += np.log(delta_a)
         return log_evidence,log_post
 
-        
-
     @property
     def maximum_logpost(self):
         x = np.linspace(1e-5, 200, 1000)
-        y = [self.log_posterior(i) for i in x]
+        y = self.log_posterior(x)
         x *= 4 * np.pi
     
         return x, y, x[np.argmax(y)]
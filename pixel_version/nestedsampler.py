@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
 import numpy as np
 import healpy as hp
-import cpnest
-import cpnest.model
 import argparse
-import shutil
 import os
 
 from detections import Event, Run
 from setup import events_list, runs_list
-from model import Model
+from model import Model, HarmonicModel
+from rotcache import RotationCache
+from samplers import LikelihoodPool, prepare_output, samplers
+
+try:
+    from cpnest.model import Model as PosteriorBase
+except ImportError:
+    # cpnest is only needed by its backend
+    PosteriorBase = object
 
 """Location of directory"""
 path = os.path.dirname(__file__)
@@ -17,27 +22,128 @@ folder = os.path.basename(path)
 parent = path.replace(folder,"") # parent directory
 # parent = '../BH-Iso/pixel_version'
 
-class PixelPosterior(cpnest.model.Model):
+class PixelPosterior(PosteriorBase):
     def __init__(self, model):
         self.model = model
 
-        self.names = self.model.weight_pars.copy()
+        # same column order as the batch methods of the model
+        self.names = self.model.param_names
         self.bounds = [(1e-5, 25)] * len(self.model.weight_pars)
-        self.names += self.model.rot_pars.copy()
         if model._weights_nside == 1:
             self.bounds += [(0, 2*np.pi), (0.75,  1.0), (0, 2*np.pi)]
         else:
             self.bounds += [(0, 2*np.pi), (0.94,  1.0), (0, 2*np.pi)]
 
+    def share_memory(self):
+        """Puts the model arrays in shared memory, see Model.share_memory"""
+        self.model.share_memory()
+
+    def in_bounds(self, x):
+        return all(lo <= x[n] <= hi for n, (lo, hi) in zip(self.names,
+                                                          self.bounds))
+
+    def prior_transform(self, u):
+        """Maps points of the unit cube onto the prior, ignoring the bounds
+        on the weights and the rotation prior. With w = R * N / (4 pi) * f
+        the rate prior is p(R) ~ R**-0.5 within the rate bounds and f
+        uniform on the simplex: the first unit coordinate gives R, the next
+        N - 1 the fractions by stick breaking, the last three the Euler
+        angles within their bounds.
+        """
+        u = np.asarray(u, dtype=np.float64)
+        single = u.ndim == 1
+        u = np.atleast_2d(u)
+        N = len(self.model.weight_pars)
+        lo, hi = np.sqrt(self.model.rate_bounds)
+        R = (lo + u[:, 0] * (hi - lo))**2
+        f = np.empty((len(u), N))
+        rest = np.ones(len(u))
+        for i in range(N - 1):
+            # Beta(1, N - 1 - i) share of what is left
+            share = 1 - (1 - u[:, i + 1])**(1 / (N - 1 - i))
+            f[:, i] = rest * share
+            rest = rest * (1 - share)
+        f[:, N - 1] = rest
+        x = np.empty(u.shape)
+        x[:, :N] = (R * N / (4 * np.pi))[:, None] * f
+        bounds = np.array(self.bounds[N:])
+        x[:, N:] = bounds[:, 0] + u[:, N:] * (bounds[:, 1] - bounds[:, 0])
+        return x[0] if single else x
+
     def log_prior(self, x):
         if self.in_bounds(x):
             return self.model.logprior(x)
         else:
-            return -np.infty
+            return -np.inf
 
     def log_likelihood(self, x):
         return self.model.loglikelihood(x)
 
+    def log_prior_batch(self, x):
+        """Log prior of the rows of an (n, parameters) array, columns
+        ordered as self.names"""
+        x = np.atleast_2d(x)
+        bounds = np.array(self.bounds)
+        inside = np.all((x >= bounds[:, 0]) & (x <= bounds[:, 1]), axis=1)
+        lp = np.full(len(x), -np.inf)
+        if np.any(inside):
+            lp[inside] = self.model.logprior_batch(x[inside])
+        return lp
+
+    def log_likelihood_batch(self, x):
+        """Log likelihood of the rows of an (n, parameters) array"""
+        return self.model.loglikelihood_batch(np.atleast_2d(x))
+
+    def log_posterior_batch(self, x):
+        """Log posterior of the rows of an (n, parameters) array. The
+        likelihood is only evaluated where the prior is finite."""
+        x = np.atleast_2d(x)
+        lp = self.log_prior_batch(x)
+        finite = np.isfinite(lp)
+        if np.any(finite):
+            lp[finite] += self.log_likelihood_batch(x[finite])
+        return lp
+
+
+class HarmonicPosterior(PixelPosterior):
+    """Posterior of a model.HarmonicModel. The monopole c0_0 = R / sqrt(4 pi)
+    is bounded by the rate bounds and every other coefficient by the
+    range of c_lm / c0_0 over the non-negative densities
+    (HarmonicModel.shape_bounds). The rotation is free over the whole
+    sphere. The non-negative densities fill a shrinking share of that box
+    as coefficients are added (about half for lmax = 1, 3e-4 for all the
+    orders of lmax = 2), which sets the cost of dynesty's support estimate;
+    the axisymmetric model stays cheap."""
+    def __init__(self, model):
+        self.model = model
+        self.names = self.model.param_names
+        self._shape_bounds = self.model.shape_bounds()
+        c00 = np.array(self.model.rate_bounds) / np.sqrt(4 * np.pi)
+        self.bounds = [tuple(c00)]
+        self.bounds += [(lo * c00[1], hi * c00[1]) for lo, hi in self._shape_bounds]
+        self.bounds += [(0, 2*np.pi), (-1.0, 1.0), (0, 2*np.pi)]
+
+    def prior_transform(self, u):
+        """Maps points of the unit cube onto the prior, ignoring the
+        positivity of the density. With c_lm = c0_0 s_lm the prior is
+        p(R) ~ R**-0.5 within the rate bounds and s uniform within the
+        shape bounds: the first unit coordinate gives R, the next the
+        shape s, the last three the Euler angles.
+        """
+        u = np.asarray(u, dtype=np.float64)
+        single = u.ndim == 1
+        u = np.atleast_2d(u)
+        K = len(self.model.coeff_pars)
+        lo, hi = np.sqrt(self.model.rate_bounds)
+        c00 = (lo + u[:, 0] * (hi - lo))**2 / np.sqrt(4 * np.pi)
+        lo, hi = self._shape_bounds.T
+        x = np.empty(u.shape)
+        x[:, 0] = c00
+        x[:, 1:K] = c00[:, None] * (lo + u[:, 1:K] * (hi - lo))
+        bounds = np.array(self.bounds[K:])
+        x[:, K:] = bounds[:, 0] + u[:, K:] * (bounds[:, 1] - bounds[:, 0])
+        return x[0] if single else x
+
 
 def main():
     parser = argparse.ArgumentParser(description='Anisotropy analysis code')
@@ -46,29 +152,93 @@ def main():
     parser.add_argument('--mult', type=int, default=10,
                         help='Multiplicity of simulated GW170814')
     parser.add_argument('--nthreads', type=int, default=10,
-                        help='Number of cores to request')
+                        help='Number of worker processes')
     parser.add_argument('--output',default='nested_sampling',
                         help='Output directory')
     parser.add_argument('--nside', default=1, type=int,help='nside for pixel model')
+    parser.add_argument('--model', default='pixel', choices=['pixel', 'harmonic'],
+                        help='Pixel weights or spherical harmonics (default: pixel)')
+    parser.add_argument('--lmax', type=int, default=1,
+                        help='Maximum degree of the harmonic model')
+    parser.add_argument('--axisymmetric', action='store_true', default=False,
+                        help='Only the m = 0 harmonics, oriented by the rotation')
+    parser.add_argument('--sampler', default='cpnest', choices=sorted(samplers),
+                        help='Sampler backend (default: cpnest)')
+    parser.add_argument('--nlive', type=int, default=10000,
+                        help='Number of live points')
+    parser.add_argument('--maxmcmc', type=int, default=20000,
+                        help='Maximum MCMC steps of cpnest')
+    parser.add_argument('--steps', type=int, default=2000,
+                        help='Steps per chain of the gibbs sampler')
+    parser.add_argument('--seed', type=int, default=1234, help='Random seed')
+    parser.add_argument('--rotation-resolution', type=float, default=0,
+                        help='Snap rotations to a grid of this fraction of '
+                        'the pofd pixel size and cache their pixel indices '
+                        '(default: 0, exact rotations)')
+    parser.add_argument('--rotation-cache-mb', type=float, default=256,
+                        help='Memory cap of the rotation cache in MB')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='Continue the run in the output directory from '
+                        'its last checkpoint')
+    parser.add_argument('--clear', action='store_true', default=False,
+                        help='Delete the contents of the output directory first')
+    parser.add_argument('--checkpoint-interval', type=float, default=600,
+                        help='Seconds between checkpoints (default: 600)')
     args = parser.parse_args()
+    if args.model == 'harmonic' and args.sampler == 'gibbs':
+        parser.error('the gibbs sampler needs the pixel model')
     events = events_list(simulated=args.simulated, multiplicity=args.mult)
     runs = runs_list()
-    model = Model(events, runs, weights_nside=args.nside)
-    post = PixelPosterior(model)
-    # if output file already exists clear it
-    if os.path.exists(args.output):
-        #inp = input('Clear {}? ("yes" to confirm)'.format(args.output))
-        inp = 'yes'
-        if inp == 'yes':
-            shutil.rmtree(args.output)
-            os.mkdir(args.output)
-    ns = cpnest.CPNest(post, nlive=10000, output=args.output,
-                       nthreads=args.nthreads, verbose=2, maxmcmc=20000,
-                       resume=False)
-    ns.run()
-    ns.plot()
-    posterior_samples = ns.get_posterior_samples(\
-                        filename=Path + args.output + 'posterior.dat')
+    if args.model == 'harmonic':
+        model = HarmonicModel(events, runs, args.lmax,
+                              axisymmetric=args.axisymmetric)
+        post = HarmonicPosterior(model)
+    else:
+        cache = None
+        if args.rotation_resolution > 0:
+            cache = RotationCache.for_nside(events[0]._nside,
+                                            args.rotation_resolution,
+                                            int(args.rotation_cache_mb * 2**20))
+        model = Model(events, runs, weights_nside=args.nside,
+                      rotation_cache=cache)
+        post = PixelPosterior(model)
+    if args.nthreads > 1:
+        post.share_memory()
+    # everything a resumed run must share with the original one
+    fingerprint = model.fingerprint()
+    fingerprint.update(model=args.model, sampler=args.sampler, nlive=args.nlive, seed=args.seed,
+                       maxmcmc=args.maxmcmc, steps=args.steps,
+                       simulated=args.simulated,
+                       mult=args.mult,
+                       rotation_resolution=args.rotation_resolution)
+    # one gibbs chain per worker, and cpnest's resume state depends on the
+    # number of its processes
+    chains = max(args.nthreads, 1)
+    if args.sampler == 'gibbs':
+        fingerprint.update(chains=chains)
+    elif args.sampler == 'cpnest':
+        fingerprint.update(nthreads=args.nthreads)
+    resume = prepare_output(args.output, fingerprint, resume=args.resume,
+                            clear=args.clear)
+    with LikelihoodPool(post, args.nthreads) as pool:
+        sampler = samplers[args.sampler](
+            post, pool, args.output, nlive=args.nlive, seed=args.seed,
+            resume=resume, checkpoint_interval=args.checkpoint_interval,
+            maxmcmc=args.maxmcmc, steps=args.steps, chains=chains)
+        summary = sampler.run()
+    if summary['log_evidence'] is not None:
+        print('log_evidence = {log_evidence} +/- {log_evidence_err}'.format(**summary))
+    else:
+        # MCMC, no evidence
+        print('{chains} chains of {steps} steps ({burn} burn in), rotation '
+              'acceptance = {rotation_acceptance:.3f} of '
+              '{rotation_evaluations} proposals'.format(**summary))
+    if summary.get('rotation_cache_hit_rate') is not None:
+        print('rotation cache hit rate = {rotation_cache_hit_rate:.3f} '
+              '({rotation_cache_hits} of {rotation_cache_lookups} '
+              'lookups)'.format(**summary))
+    elif 'rotation_cache_hit_rate' in summary:
+        print('rotation cache hit rate unknown, a worker did not report it')
     
 if __name__=='__main__':
     main()
@@ -0,0 +1,134 @@
+"""LRU cache of rotated pixel indices on a quantised grid of rotations.
+
+Samplers keep proposing rotations in the small region of SO(3) allowed by
+the rotation prior. Snapping the Euler angles (a, arccos(cosb), c) to a grid
+of step `resolution` makes nearby proposals share one rotation, so the
+pixel lookups done for it (hp.vec2pix over the rotated pixel centres and
+posterior samples) are computed once and reused. Each angle moves by at
+most resolution / 2, so a point on the sky moves by at most
+1.5 * resolution; keep it well below the pixel size (hp.nside2resol).
+"""
+from collections import OrderedDict
+
+import numpy as np
+import healpy as hp
+from transforms3d.euler import euler2mat
+
+
+class RotationCache(object):
+    """Memoises arrays computed for quantised rotations.
+
+    Parameters
+    ----------
+        resolution: float
+            Grid step of the Euler angles, radians
+        max_bytes: int (default 2**28)
+            Memory cap of the cached arrays. Least recently used rotations
+            are evicted beyond it
+        axes: str (default 'rzyz')
+            Order of Euler rotations
+    """
+    def __init__(self, resolution, max_bytes=2**28, axes='rzyz'):
+        if resolution <= 0:
+            raise ValueError('resolution must be positive')
+        self.resolution = resolution
+        self.max_bytes = max_bytes
+        self._axes = axes
+        self._entries = OrderedDict() # rotmat bytes -> {name: array}
+        self._rotations = OrderedDict() # grid node -> rotmat
+        self.max_nodes = 2**16
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def for_nside(cls, nside, fraction=0.1, max_bytes=2**28, axes='rzyz'):
+        """Cache whose grid step is a fraction of the pixel size of nside"""
+        return cls(fraction * hp.nside2resol(nside), max_bytes, axes)
+
+    def node(self, a, cosb, c):
+        """Grid node of the rotation with Euler angles (a, arccos(cosb), c)"""
+        beta = np.arccos(np.clip(cosb, -1, 1))
+        return tuple(int(k) for k in
+                     np.round(np.array([a, beta, c]) / self.resolution))
+
+    def rotation(self, a, cosb, c):
+        """Rotation matrix of the grid node closest to (a, arccos(cosb), c).
+        The same array is returned for every angle snapping to a node.
+        """
+        node = self.node(a, cosb, c)
+        rotmat = self._rotations.get(node)
+        if rotmat is None:
+            a, beta, c = np.array(node) * self.resolution
+            rotmat = euler2mat(a, beta, c, axes=self._axes)
+            rotmat.flags.writeable = False
+            self._rotations[node] = rotmat
+            # the matrices are tiny, only bound their number
+            if len(self._rotations) > self.max_nodes:
+                self._rotations.popitem(last=False)
+        else:
+            self._rotations.move_to_end(node)
+        return rotmat
+
+    def lookup(self, rotmat, name, func):
+        """func(rotmat), computed once per rotation and name
+
+        Parameters
+        ----------
+            rotmat: np.array (3,3)
+                Rotation matrix, normally from rotation()
+            name: hashable
+                Which quantity func computes
+            func: callable
+                Maps rotmat to a numpy array
+        """
+        key = np.ascontiguousarray(rotmat, dtype=np.float64).tobytes()
+        entry = self._entries.get(key)
+        if entry is not None and name in entry:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[name]
+        self.misses += 1
+        value = np.asarray(func(rotmat))
+        value.flags.writeable = False
+        if entry is None:
+            entry = self._entries[key] = {}
+        self._entries.move_to_end(key)
+        entry[name] = value
+        self.nbytes += value.nbytes
+        self._evict()
+        return value
+
+    def _evict(self):
+        # keep at least the entry just used
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            self.nbytes -= sum(value.nbytes for value in entry.values())
+
+    @property
+    def hit_rate(self):
+        """Share of lookups answered from the cache"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def empty_copy(self):
+        """Cache with the same settings and no entries"""
+        cache = RotationCache(self.resolution, self.max_bytes, self._axes)
+        cache.max_nodes = self.max_nodes
+        return cache
+
+    def clear(self):
+        self._entries.clear()
+        self._rotations.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return ('RotationCache(resolution={:.3g}, rotations={}, '
+                'MB={:.1f}, hit_rate={:.3f})'.format(
+                    self.resolution, len(self), self.nbytes / 2**20,
+                    self.hit_rate))
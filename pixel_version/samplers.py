@@ -0,0 +1,619 @@
+"""Sampler backends for the pixel model.
+
+Every backend runs a posterior object (nestedsampler.PixelPosterior) with a
+LikelihoodPool of worker processes and writes the same output layout:
+
+    output/posterior.dat    equal weight posterior samples, header names + logL
+    output/evidence.json    log evidence, its error, run time, settings and
+                            the hit rate of the rotation cache
+    output/fingerprint.json what the run was set up with, see prepare_output
+    output/<sampler>/       whatever the sampler itself writes, including
+                            its periodic checkpoints with its random state
+
+so that runs of different samplers can be compared directly. The samplers
+themselves are optional dependencies, imported when a backend is used.
+"""
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+# posterior of this process, set once per worker so tasks only carry points
+_posterior = None
+# shared by the pool workers, see LikelihoodPool.cache_counts
+_barrier = None
+# stands in for log(0) with samplers that require finite values
+_LOGL_FLOOR = -1e300
+
+
+def _write_atomic(path, write):
+    """Calls write(f) on a temporary file and moves it to path, so path
+    only ever holds complete files"""
+    with open(path + '.tmp', 'w') as f:
+        write(f)
+    os.replace(path + '.tmp', path)
+
+
+def _write_json(path, obj):
+    _write_atomic(path, lambda f: json.dump(obj, f, indent=2))
+
+
+def prepare_output(output, fingerprint, resume=False, clear=False):
+    """Sets up the output directory of a run.
+
+    A new run refuses to write into a directory that holds another run
+    unless clear is set, in which case that run is deleted. Resuming
+    refuses if the fingerprint differs from that of the run in output.
+
+    Parameters
+    ----------
+        output: str
+            Output directory
+        fingerprint: dict
+            JSON serialisable description of the run, e.g. Model.fingerprint
+            with the sampler settings
+        resume: bool (default False)
+            Continue the run in output from its last checkpoint
+        clear: bool (default False)
+            Delete the contents of output first
+
+    Returns
+    -------
+        bool, whether there is a run to resume
+    """
+    path = os.path.join(output, 'fingerprint.json')
+    # round trip so tuples compare equal to the lists read back
+    fingerprint = json.loads(json.dumps(fingerprint))
+    if resume and os.path.exists(path):
+        with open(path) as f:
+            previous = json.load(f)
+        changed = sorted(k for k in set(previous) | set(fingerprint)
+                         if previous.get(k) != fingerprint.get(k))
+        if changed:
+            raise ValueError('cannot resume the run in {}, it was set up '
+                             'with different {}'.format(output,
+                                                        ', '.join(changed)))
+        return True
+    if os.path.exists(output) and os.listdir(output):
+        if resume and not clear:
+            raise ValueError('{} holds no run to resume (no fingerprint.json), '
+                             'pass --clear to delete it and start '
+                             'again'.format(output))
+        if not clear:
+            raise ValueError('{} is not empty, pass --resume to continue the '
+                             'run there or --clear to delete it'.format(output))
+        shutil.rmtree(output)
+    os.makedirs(output, exist_ok=True)
+    _write_json(path, fingerprint)
+    return False
+
+
+def _init_worker(posterior, barrier=None):
+    global _posterior, _barrier
+    _posterior = posterior
+    _barrier = barrier
+    cache = _rotation_cache(posterior)
+    if barrier is not None and cache is not None:
+        # a forked worker inherits the cache of the parent, count only its
+        # own lookups
+        cache.clear()
+
+
+def _rotation_cache(posterior):
+    """Rotation cache of the model of a posterior, None without one"""
+    return getattr(getattr(posterior, 'model', None), 'rotation_cache', None)
+
+
+def _cache_counts(task=None):
+    """(hits, lookups) of the rotation cache of this process. In a pool
+    worker, waits for the other workers first so that each of them takes
+    exactly one of LikelihoodPool.processes tasks. None if they do not
+    all turn up."""
+    if _barrier is not None:
+        try:
+            _barrier.wait(60)
+        except threading.BrokenBarrierError:
+            return None
+    cache = _rotation_cache(_posterior)
+    if cache is None:
+        return 0, 0
+    return cache.hits, cache.hits + cache.misses
+
+
+def _count_at_exit(queue):
+    """Run in a process forked by multiprocessing, see
+    CPNestSampler: puts the (hits, lookups) the process adds to the
+    rotation cache into queue when it exits"""
+    start = _cache_counts()
+    def put():
+        hits, lookups = _cache_counts()
+        queue.put((hits - start[0], lookups - start[1]))
+    multiprocessing.util.Finalize(None, put, exitpriority=10)
+
+
+def _call_batch(task):
+    method, x = task
+    return getattr(_posterior, method)(x)
+
+
+def _log_likelihood(x):
+    """Log likelihood of a point, -1e300 outside the support of the prior
+    (see PixelPosterior.prior_transform)"""
+    if not np.isfinite(_posterior.log_prior_batch(x)[0]):
+        return _LOGL_FLOOR
+    return _posterior.log_likelihood_batch(x)[0]
+
+
+def _prior_transform(u):
+    return _posterior.prior_transform(u)
+
+
+class LikelihoodPool(object):
+    """Process pool evaluating a posterior, shared by all the backends.
+
+    The posterior is sent to each worker once, when the pool starts, so
+    tasks carry only the points. The pool starts on first use; samplers
+    that manage their own processes (cpnest) only read `processes`.
+
+    Parameters
+    ----------
+        posterior: nestedsampler.PixelPosterior
+            Posterior with log_prior_batch and log_likelihood_batch
+        processes: int (default 1)
+            Number of worker processes. With 1 everything runs in this process
+    """
+    def __init__(self, posterior, processes=1):
+        self.posterior = posterior
+        self.processes = processes
+        self._pool = None
+        self._barrier = None
+        _init_worker(posterior)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def size(self):
+        """Number of points sent out at once, as expected by dynesty"""
+        return self.processes
+
+    def _start(self):
+        if self._pool is None and self.processes > 1:
+            # workers attach to the model arrays rather than copying them
+            share_memory = getattr(self.posterior, 'share_memory', None)
+            if share_memory is not None:
+                share_memory()
+            self._barrier = multiprocessing.Barrier(self.processes)
+            self._pool = multiprocessing.Pool(self.processes, _init_worker,
+                                              (self.posterior, self._barrier))
+        return self._pool
+
+    def map(self, func, iterable):
+        """map() over the workers, func being a module level function"""
+        pool = self._start()
+        if pool is None:
+            return list(map(func, iterable))
+        return pool.map(func, iterable)
+
+    def batch(self, method, x):
+        """posterior.method(x) of an (n, parameters) array, the rows split
+        evenly over the workers"""
+        x = np.atleast_2d(x)
+        chunks = [c for c in np.array_split(x, max(self.processes, 1))
+                  if len(c)]
+        return np.concatenate(self.map(_call_batch,
+                                       [(method, c) for c in chunks]))
+
+    def log_prior(self, x):
+        return self.batch('log_prior_batch', x)
+
+    def log_likelihood(self, x):
+        return self.batch('log_likelihood_batch', x)
+
+    def log_posterior(self, x):
+        return self.batch('log_posterior_batch', x)
+
+    def cache_counts(self):
+        """(hits, lookups) of the rotation caches of this process and of
+        the workers, None if a worker did not answer"""
+        hits, lookups = _cache_counts()
+        if self._pool is not None:
+            for counts in self._pool.map(_cache_counts, range(self.processes),
+                                         chunksize=1):
+                if counts is None:
+                    return None
+                hits, lookups = hits + counts[0], lookups + counts[1]
+        return hits, lookups
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+class Sampler(object):
+    """Common part of the backends.
+
+    Parameters
+    ----------
+        posterior: nestedsampler.PixelPosterior
+        pool: LikelihoodPool
+        output: str
+            Output directory
+        nlive: int (default 1000)
+            Number of live points
+        seed: int (default 1234)
+            Random seed
+        resume: bool (default False)
+            Continue from the checkpoints in output. Each backend's own
+            checkpoint holds its random state
+        checkpoint_interval: float (default 600)
+            Seconds between checkpoints of the sampler
+    """
+    name = None
+
+    def __init__(self, posterior, pool, output, nlive=1000, seed=1234,
+                 resume=False, checkpoint_interval=600, **kwargs):
+        self.posterior = posterior
+        self.pool = pool
+        self.output = output
+        self.nlive = nlive
+        self.seed = seed
+        self.resume = resume
+        self.checkpoint_interval = checkpoint_interval
+        self.options = kwargs
+        self.runtime = None
+        self.rng = np.random.default_rng(seed)
+        # rotation cache (hits, lookups) of processes outside the pool
+        self.extra_counts = (0, 0)
+
+    @property
+    def sampler_output(self):
+        """Directory for the files written by the sampler itself"""
+        return os.path.join(self.output, self.name)
+
+    def run(self):
+        """Runs the sampler and writes the common output.
+
+        Returns
+        -------
+            dict with the contents of evidence.json
+        """
+        os.makedirs(self.sampler_output, exist_ok=True)
+        start = time.time()
+        samples, logl, summary = self._run()
+        self.runtime = time.time() - start
+        summary.update(sampler=self.name, nlive=self.nlive, seed=self.seed,
+                       processes=self.pool.processes, runtime=self.runtime,
+                       resumed=self.resume, names=list(self.posterior.names))
+        if _rotation_cache(self.posterior) is not None:
+            summary.update(self.cache_summary())
+        self.write(samples, logl, summary)
+        return summary
+
+    def cache_summary(self):
+        """Lookups of the rotation caches of all the processes of the run
+        and the share of them answered from the caches. The hit rate is
+        what --rotation-resolution trades against the accuracy of the
+        likelihood; it only covers this session of a resumed run."""
+        counts = self.pool.cache_counts()
+        if counts is None:
+            return {'rotation_cache_hits': None,
+                    'rotation_cache_lookups': None,
+                    'rotation_cache_hit_rate': None}
+        hits = counts[0] + self.extra_counts[0]
+        lookups = counts[1] + self.extra_counts[1]
+        return {'rotation_cache_hits': int(hits),
+                'rotation_cache_lookups': int(lookups),
+                'rotation_cache_hit_rate': hits / lookups if lookups else 0.0}
+
+    def _run(self):
+        """Returns the posterior samples (n, parameters), their log
+        likelihood and a dict with at least log_evidence and
+        log_evidence_err"""
+        raise NotImplementedError
+
+    def write(self, samples, logl, summary):
+        header = ' '.join(list(self.posterior.names) + ['logL'])
+        _write_atomic(os.path.join(self.output, 'posterior.dat'),
+                      lambda f: np.savetxt(f, np.column_stack([samples, logl]),
+                                           header=header))
+        _write_json(os.path.join(self.output, 'evidence.json'), summary)
+
+
+class CPNestSampler(Sampler):
+    """cpnest backend. cpnest runs its own sampler processes, as many as
+    the pool has workers, and checkpoints them itself, resuming from its
+    resume file in the sampler directory.
+
+    Extra options: maxmcmc (default 20000), verbose (default 2)
+    """
+    name = 'cpnest'
+
+    def _run(self):
+        import cpnest
+        # the sampler processes of cpnest report their cache lookups as
+        # they exit (only when they are forked)
+        queue = multiprocessing.SimpleQueue()
+        multiprocessing.util.register_after_fork(queue, _count_at_exit)
+        ns = cpnest.CPNest(self.posterior, nlive=self.nlive,
+                           output=self.sampler_output,
+                           nthreads=self.pool.processes,
+                           verbose=self.options.get('verbose', 2),
+                           maxmcmc=self.options.get('maxmcmc', 20000),
+                           seed=self.seed, resume=self.resume,
+                           periodic_checkpoint_interval=self.checkpoint_interval)
+        ns.run()
+        hits, lookups = self.extra_counts
+        while not queue.empty():
+            counts = queue.get()
+            hits, lookups = hits + counts[0], lookups + counts[1]
+        self.extra_counts = (hits, lookups)
+        if self.options.get('plot', True):
+            ns.plot()
+        post = ns.get_posterior_samples()
+        samples = np.column_stack([post[n] for n in self.posterior.names])
+        logz = getattr(ns, 'logZ', None)
+        if logz is None:
+            logz = ns.NS.logZ
+        # error from the information gained, sqrt(H / nlive)
+        info = getattr(getattr(ns.NS, 'state', None), 'info', np.nan)
+        summary = {'log_evidence': float(logz),
+                   'log_evidence_err': float(np.sqrt(info / self.nlive))}
+        return samples, post['logL'], summary
+
+
+class DynestySampler(Sampler):
+    """dynesty backend, with the likelihood spread over the pool.
+
+    dynesty draws from the prior through posterior.prior_transform, which
+    ignores the rotation and weight bounds; points outside them get a log
+    likelihood of -1e300. The evidence is then that of the truncated
+    prior times the probability p of its support, so log(p), estimated
+    from `support_draws` prior draws, is subtracted to match the other
+    backends.
+
+    Extra options: bound (default 'multi'), sample (default 'rwalk'),
+    dlogz (default 0.1), support_draws (default 2**20)
+    """
+    name = 'dynesty'
+
+    def log_support(self):
+        """log of the prior probability of the support, and its error"""
+        rng = np.random.default_rng(self.seed)
+        ndim = len(self.posterior.names)
+        draws = self.options.get('support_draws', 2**20)
+        inside = 0
+        for n in np.diff(np.append(np.arange(0, draws, 2**16), draws)):
+            x = self.posterior.prior_transform(rng.uniform(size=(n, ndim)))
+            inside += np.sum(np.isfinite(self.pool.log_prior(x)))
+        p = inside / draws
+        return np.log(p), np.sqrt((1 - p) / (p * draws))
+
+    def _run(self):
+        import dynesty
+        from dynesty.utils import resample_equal
+        ndim = len(self.posterior.names)
+        pool = self.pool if self.pool.processes > 1 else None
+        # dynesty saves its state, random generator included, atomically
+        save = os.path.join(self.sampler_output, 'dynesty.save')
+        if self.resume and os.path.exists(save):
+            sampler = dynesty.NestedSampler.restore(save, pool=pool)
+        else:
+            sampler = dynesty.NestedSampler(
+                _log_likelihood, _prior_transform, ndim, nlive=self.nlive,
+                bound=self.options.get('bound', 'multi'),
+                sample=self.options.get('sample', 'rwalk'),
+                pool=pool, queue_size=self.pool.processes, rstate=self.rng)
+        sampler.run_nested(dlogz=self.options.get('dlogz', 0.1),
+                           checkpoint_file=save,
+                           checkpoint_every=self.checkpoint_interval,
+                           resume=self.resume and os.path.exists(save))
+        res = sampler.results
+        np.save(os.path.join(self.sampler_output, 'results.npy'),
+                dict(res.items()), allow_pickle=True)
+        weights = np.exp(res.logwt - res.logz[-1])
+        order = resample_equal(np.arange(len(weights)), weights / np.sum(weights),
+                               rstate=self.rng)
+        samples = res.samples[order]
+        log_support, log_support_err = self.log_support()
+        summary = {'log_evidence': float(res.logz[-1] - log_support),
+                   'log_evidence_err': float(np.hypot(res.logzerr[-1],
+                                                      log_support_err)),
+                   'log_support': float(log_support),
+                   'likelihood_calls': int(np.sum(res.ncall))}
+        return samples, res.logl[order], summary
+
+
+def _weights_target(model, rotmat, log_w, upper):
+    """Log posterior of the weights at a fixed rotation in log w, with the
+    log w Jacobian, and its gradient. -inf outside the bounds."""
+    w = np.exp(log_w)
+    if np.any(w > upper):
+        return -np.inf, None
+    lp = model.logprior_rate(w)
+    if not np.isfinite(lp):
+        return -np.inf, None
+    S, E = model.statistics(rotmat)
+    rates = np.matmul(S, w)
+    logp = - np.dot(E, w) + np.sum(np.log(rates)) + lp + np.sum(log_w)
+    grad = model.grad_loglikelihood(rotmat, w) + model.grad_logprior_rate(w)
+    return logp, w * grad + 1
+
+
+def _hmc_step(model, rotmat, log_w, current, eps, nleap, upper, rng):
+    """One Hamiltonian Monte Carlo trajectory of the weights in log w.
+    current is (logp, grad) at log_w. Returns the new point, its
+    (logp, grad) and the acceptance probability."""
+    p = rng.normal(size=log_w.size)
+    logp, grad = current
+    h0 = logp - 0.5 * np.dot(p, p)
+    x = log_w.copy()
+    p = p + 0.5 * eps * grad
+    for i in range(nleap):
+        x = x + eps * p
+        logp_new, grad_new = _weights_target(model, rotmat, x, upper)
+        if not np.isfinite(logp_new):
+            return log_w, current, 0.0
+        if i < nleap - 1:
+            p = p + eps * grad_new
+    p = p + 0.5 * eps * grad_new
+    accept = np.exp(min(0.0, logp_new - 0.5 * np.dot(p, p) - h0))
+    if rng.uniform() < accept:
+        return x, (logp_new, grad_new), accept
+    return log_w, current, accept
+
+
+def _start_point(post, rng, tries=100):
+    """Starting point of a chain: equal weights at the isotropic maximum
+    likelihood rate and the identity rotation, with the weights jittered
+    by rng so that chains start apart. The jitter is drawn again while it
+    leaves the support of the prior."""
+    model = post.model
+    K = len(model.weight_pars)
+    bounds = np.array(post.bounds)
+    # -E.w + sum log(S w) at equal weights w0 peaks at w0 = events / sum(E)
+    _, E = model.statistics(np.eye(3))
+    w0 = np.clip(model._n_events / np.sum(E), bounds[:K, 0], bounds[:K, 1])
+    x0 = np.concatenate([w0, [0.0, 1.0, 0.0]]) # (a, cosb, c) of the identity
+    for i in range(tries):
+        x = x0.copy()
+        x[:K] *= np.exp(0.1 * rng.normal(size=K))
+        if np.isfinite(post.log_prior_batch(x)[0]):
+            return x
+    if np.isfinite(post.log_prior_batch(x0)[0]):
+        return x0
+    raise RuntimeError('no starting point within the prior: equal weights '
+                       'of {:.3g} at the identity rotation are outside '
+                       'it'.format(w0[0]))
+
+
+def _gibbs_chain(task):
+    """Runs one chain of GibbsSampler in a worker, see GibbsSampler"""
+    (index, seed, output, resume, interval, nsteps, burn, thin, nleap,
+     target_accept) = task
+    post = _posterior
+    model = post.model
+    K = len(model.weight_pars)
+    bounds = np.array(post.bounds)
+    upper = bounds[:K, 1]
+    path = os.path.join(output, 'chain{}.npz'.format(index))
+    rng = np.random.default_rng(seed)
+    if resume and os.path.exists(path):
+        saved = np.load(path)
+        x, it = saved['x'], int(saved['it'])
+        log_eps, log_sigma = float(saved['log_eps']), float(saved['log_sigma'])
+        samples, logl = list(saved['samples']), list(saved['logl'])
+        counts = saved['counts']
+        rng.bit_generator.state = json.loads(str(saved['rng']))
+    else:
+        x = _start_point(post, rng)
+        it, log_eps, log_sigma = 0, np.log(0.05), np.log(0.01)
+        samples, logl = [], []
+        # rotation proposals and acceptances, weight trajectories
+        counts = np.zeros(3)
+    log_w = np.log(x[:K])
+    angles = x[K:]
+    pars = dict(zip(model.rot_pars, angles))
+    rotmat = model.rotation(pars)
+    current = _weights_target(model, rotmat, log_w, upper)
+    last_save = time.time()
+    while it < nsteps:
+        # weights at fixed rotation, step size adapted towards target_accept
+        log_w, current, accept = _hmc_step(model, rotmat, log_w, current,
+                                           np.exp(log_eps), nleap, upper, rng)
+        counts[2] += 1
+        if it < burn:
+            log_eps += (accept - target_accept) / np.sqrt(it + 10)
+        # Metropolis update of the Euler angles at fixed weights
+        new_angles = angles + np.exp(log_sigma) * rng.normal(size=3)
+        point = np.concatenate([np.exp(log_w), new_angles])
+        accept = 0.0
+        if np.isfinite(post.log_prior_batch(point)[0]):
+            new_pars = dict(zip(model.rot_pars, new_angles))
+            new_rotmat = model.rotation(new_pars)
+            new = _weights_target(model, new_rotmat, log_w, upper)
+            counts[0] += 1
+            accept = np.exp(min(0.0, new[0] - current[0]))
+            if rng.uniform() < accept:
+                angles, rotmat, current = new_angles, new_rotmat, new
+                counts[1] += 1
+        if it < burn:
+            log_sigma += (accept - 0.3) / np.sqrt(it + 10)
+        it += 1
+        if it > burn and (it - burn) % thin == 0:
+            w = np.exp(log_w)
+            samples.append(np.concatenate([w, angles]))
+            logl.append(- model.nexp(rotmat, w)
+                        + model.logprob_detections(rotmat, w))
+        if time.time() - last_save > interval or it == nsteps:
+            state = dict(x=np.concatenate([np.exp(log_w), angles]), it=it,
+                         log_eps=log_eps, log_sigma=log_sigma,
+                         samples=np.reshape(samples, (-1, len(bounds))),
+                         logl=np.array(logl), counts=counts,
+                         rng=json.dumps(rng.bit_generator.state))
+            with open(path + '.tmp', 'wb') as f:
+                np.savez(f, **state)
+            os.replace(path + '.tmp', path)
+            last_save = time.time()
+    return (np.reshape(samples, (-1, len(bounds))), np.array(logl), counts,
+            np.exp(log_eps), np.exp(log_sigma))
+
+
+class GibbsSampler(Sampler):
+    """Metropolis-within-Gibbs backend for many weights.
+
+    Each step alternates a Hamiltonian Monte Carlo trajectory of the
+    weights in log w at fixed rotation, using the analytic gradients of
+    Model, with a Metropolis update of the three Euler angles at fixed
+    weights. Only the rotation updates need new sufficient statistics;
+    the weight trajectories are matrix-vector products. The step sizes
+    are adapted during burn in. One chain runs per pool worker and each
+    chain saves its state to the sampler directory periodically to resume
+    from. nlive is not used.
+
+    MCMC gives no evidence: log_evidence is None.
+
+    Extra options: steps per chain (default 2000), burn (default
+    steps // 4), thin (default 1),
+    leapfrog (default 10), target_accept (default 0.8), chains
+    (default pool processes)
+    """
+    name = 'gibbs'
+
+    def _run(self):
+        nsteps = self.options.get('steps', 2000)
+        burn = self.options.get('burn', nsteps // 4)
+        chains = self.options.get('chains', max(self.pool.processes, 1))
+        seeds = np.random.SeedSequence(self.seed).generate_state(chains)
+        tasks = [(i, int(seeds[i]), self.sampler_output, self.resume,
+                  self.checkpoint_interval, nsteps, burn,
+                  self.options.get('thin', 1),
+                  self.options.get('leapfrog', 10),
+                  self.options.get('target_accept', 0.8))
+                 for i in range(chains)]
+        results = self.pool.map(_gibbs_chain, tasks)
+        samples = np.concatenate([r[0] for r in results])
+        logl = np.concatenate([r[1] for r in results])
+        counts = np.sum([r[2] for r in results], axis=0)
+        summary = {'log_evidence': None, 'log_evidence_err': None,
+                   'chains': chains, 'steps': nsteps, 'burn': burn,
+                   'rotation_evaluations': int(counts[0]),
+                   'rotation_acceptance': float(counts[1] / max(counts[0], 1)),
+                   'weight_trajectories': int(counts[2]),
+                   'step_sizes': [float(r[3]) for r in results],
+                   'rotation_scales': [float(r[4]) for r in results]}
+        return samples, logl, summary
+
+
+samplers = {'cpnest': CPNestSampler, 'dynesty': DynestySampler,
+            'gibbs': GibbsSampler}
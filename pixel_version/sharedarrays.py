@@ -0,0 +1,95 @@
+"""Read-only numpy arrays in named shared memory.
+
+The process that creates a SharedArrays copies each array once into a
+segment of its own. Pickling it sends only the segment names, shapes and
+dtypes, and unpickling attaches to the segments without copying, so any
+number of worker processes see the same pages. The creator unlinks the
+segments when it is closed or garbage collected, or at exit.
+"""
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+def _attach(name):
+    """Attaches to an existing segment without handing it to this
+    process's resource tracker, which would unlink it when we exit"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 always registers the segment, with the tracker of
+        # the creating process that pool workers inherit, which already
+        # holds it
+        return shared_memory.SharedMemory(name=name)
+
+
+def _release(segments, unlink):
+    for shm in segments.values():
+        try:
+            shm.close()
+        except BufferError:
+            # views still alive, the mapping goes with them
+            pass
+        if unlink:
+            shm.unlink()
+    segments.clear()
+
+
+class SharedArrays(object):
+    """Mapping of names to read-only arrays held in shared memory."""
+    def __init__(self):
+        self._segments = {}
+        self._specs = {}
+        self._arrays = {}
+        self._finalizer = weakref.finalize(self, _release, self._segments,
+                                           True)
+
+    def share(self, name, array):
+        """Copies array into a new segment and returns the read-only view"""
+        if name in self._segments:
+            raise ValueError('{} is already shared'.format(name))
+        array = np.ascontiguousarray(array)
+        shm = shared_memory.SharedMemory(create=True,
+                                         size=max(array.nbytes, 1))
+        self._segments[name] = shm
+        self._specs[name] = (shm.name, array.shape, array.dtype.str)
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+        view[...] = array
+        view.flags.writeable = False
+        self._arrays[name] = view
+        return view
+
+    def __getitem__(self, name):
+        return self._arrays[name]
+
+    def __contains__(self, name):
+        return name in self._arrays
+
+    def __iter__(self):
+        return iter(self._arrays)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in self._arrays.values())
+
+    def __getstate__(self):
+        return {'specs': self._specs}
+
+    def __setstate__(self, state):
+        self._specs = state['specs']
+        self._segments = {}
+        self._arrays = {}
+        for name, (shm_name, shape, dtype) in self._specs.items():
+            shm = self._segments[name] = _attach(shm_name)
+            view = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            view.flags.writeable = False
+            self._arrays[name] = view
+        # attached copies only close their handles
+        self._finalizer = weakref.finalize(self, _release, self._segments,
+                                           False)
+
+    def close(self):
+        """Drops the arrays; the creator also unlinks the segments"""
+        self._arrays.clear()
+        self._finalizer()
@@ -1,9 +1,13 @@
 import pickle
 import joblib
+import hashlib
+import json
 import datetime
 import errno
 import numpy as np
 import os
+import sys
+import collections
 
 """Location of directory"""
 path = os.path.dirname(__file__)
@@ -30,14 +34,215 @@ def openPickle(path):
 		return -1
 
 
-def savePickle(obj, path):
+def fileHash(path):
+	"""Content hash of a file, used to key products on their inputs"""
+	h = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1 << 20), b''):
+			h.update(chunk)
+	return h.hexdigest()
+
+
+def readPSD(path, det):
+	"""
+	Frequencies and amplitude spectral density in a PSD file. det is
+	'L1H1' or 'V1' for the two column analytic files of the runs, otherwise
+	the name of the PSD column of an event file (which holds the PSD).
+	"""
+	if det in ['L1H1', 'V1']:
+		PSDdata = np.genfromtxt(path)
+		return PSDdata[:, 0], PSDdata[:, 1]
+	PSDdata = np.genfromtxt(path, names=True)
+	return PSDdata['Freq'], np.sqrt(PSDdata[det])
+
+
+def makeDir(path):
+	"""Creates the directory of path if it does not exist"""
 	if not os.path.exists(os.path.dirname(path)):
 		try:
 			os.makedirs(os.path.dirname(path))
 		except OSError as exc: # Guard against race condition
 			if exc.errno != errno.EEXIST:
 				raise
-	joblib.dump(obj, path, compress=True, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def savePickle(obj, path):
+	"""Written to a temporary file and renamed, so path is never left half written"""
+	makeDir(path)
+	joblib.dump(obj, path + '.tmp', compress=True, protocol=pickle.HIGHEST_PROTOCOL)
+	os.replace(path + '.tmp', path)
+
+
+def productPaths(path):
+	"""Data (.npy) and metadata (.json) files of the product saved at path"""
+	stem = os.path.splitext(path)[0]
+	return stem + '.npy', stem + '.json'
+
+
+def saveProduct(arr, path, **meta):
+	"""
+	Saves a p(det) table or map as a .npy file that can be memory mapped,
+	with pixels along the first axis so any block of pixels is contiguous on
+	disk. The keyword arguments (nside, distance grid, provenance...) are
+	written to a .json header next to it. Both files are renamed into place.
+	"""
+	npyPath, jsonPath = productPaths(path)
+	makeDir(npyPath)
+	arr = np.ascontiguousarray(arr)
+	with open(npyPath + '.tmp', 'wb') as f:
+		np.save(f, arr)
+	os.replace(npyPath + '.tmp', npyPath)
+	meta = dict(meta, shape=list(arr.shape), dtype=arr.dtype.str,
+				created=datetime.datetime.now().isoformat())
+	with open(jsonPath + '.tmp', 'w') as f:
+		json.dump(meta, f, indent=1)
+	os.replace(jsonPath + '.tmp', jsonPath)
+
+
+def openProduct(path):
+	"""
+	Opens the product saved at path. The .npy format is memory mapped, so
+	only the pixels that are used get read. Falls back on the pickle.
+	"""
+	npyPath = productPaths(path)[0]
+	if os.path.exists(npyPath):
+		return np.load(npyPath, mmap_mode='r')
+	return openPickle(path)
+
+
+def productMeta(path):
+	"""Metadata header of the product saved at path"""
+	with open(productPaths(path)[1]) as f:
+		return json.load(f)
+
+
+class ProductCache(object):
+	"""
+	Least recently used cache of loaded products, shared by the classes of
+	a process. Entries are keyed by path and loader and stamped with the
+	mtime and size of the files behind the path, so a product that is
+	rewritten is loaded again. Entries are evicted, least recently used
+	first, once the memory they hold exceeds budget (bytes). Memory mapped
+	arrays only count for their headers, their pages belong to the OS.
+	"""
+	def __init__(self, budget=2**31):
+		self.budget = budget
+		self.__entries = collections.OrderedDict()
+		self.__sizes = {}
+		self.loads = 0
+
+	def __stamp(self, path):
+		stamp = []
+		for f in (path,) + productPaths(path):
+			try:
+				st = os.stat(f)
+				stamp.append((f, st.st_mtime_ns, st.st_size))
+			except OSError:
+				pass
+		return tuple(stamp)
+
+	def get(self, path, loader=openProduct):
+		"""The product at path as returned by loader(path), loaded on the first request"""
+		key = (path, loader)
+		stamp = self.__stamp(path)
+		if key in self.__entries and self.__entries[key][0] == stamp:
+			self.__entries.move_to_end(key)
+			return self.__entries[key][1]
+		obj = loader(path)
+		self.loads += 1
+		self.__entries[key] = (stamp, obj)
+		self.__entries.move_to_end(key)
+		self.__sizes[key] = sizeOf(obj)
+		while len(self.__entries) > 1 and sum(self.__sizes.values()) > self.budget:
+			oldest = next(iter(self.__entries))
+			del self.__entries[oldest]
+			del self.__sizes[oldest]
+		return obj
+
+	def clear(self):
+		self.__entries.clear()
+		self.__sizes.clear()
+
+
+def sizeOf(obj):
+	"""Approximate memory held by a loaded product"""
+	if isinstance(obj, np.memmap):
+		return sys.getsizeof(obj)
+	if isinstance(obj, np.ndarray):
+		return obj.nbytes
+	if isinstance(obj, dict):
+		return sum(sizeOf(v) for v in obj.values())
+	if isinstance(obj, (list, tuple)):
+		return sum(sizeOf(v) for v in obj)
+	return sys.getsizeof(obj)
+
+
+_productCache = None
+
+def productCache(budget=None):
+	"""The ProductCache of this process, with its budget updated if given"""
+	global _productCache
+	if _productCache is None:
+		_productCache = ProductCache()
+	if budget is not None:
+		_productCache.budget = budget
+	return _productCache
+
+
+class Lazy(object):
+	"""A deferred call, evaluated on every access to a LazyRecord entry"""
+	def __init__(self, func, *args):
+		self.func = func
+		self.args = args
+
+	def __call__(self):
+		return self.func(*self.args)
+
+
+class LazyRecord(dict):
+	"""dict whose Lazy values are only evaluated when they are looked up"""
+	def __getitem__(self, key):
+		value = dict.__getitem__(self, key)
+		if isinstance(value, Lazy):
+			return value()
+		return value
+
+
+def openPartial(path, shape, fingerprint):
+	"""
+	Opens the partial result of the table that will be saved at path, as a
+	memory mapped array and the set of the finished block starts. Starts
+	afresh if there is none, or if it was computed from other inputs.
+	"""
+	makeDir(path)
+	try:
+		with open(path + '.partial.json') as f:
+			state = json.load(f)
+		if state['fingerprint'] == fingerprint and tuple(state['shape']) == tuple(shape):
+			table = np.lib.format.open_memmap(path + '.partial.npy', mode='r+')
+			print('Resuming %s, %d blocks done' %(os.path.basename(path), len(state['done'])))
+			return table, set(state['done'])
+		print('Inputs changed since the partial result of %s, starting again' %(os.path.basename(path)))
+	except (IOError, ValueError, KeyError):
+		pass
+	table = np.lib.format.open_memmap(path + '.partial.npy', mode='w+', dtype=np.float64, shape=shape)
+	savePartialState(path, shape, fingerprint, set())
+	return table, set()
+
+
+def savePartialState(path, shape, fingerprint, done):
+	"""Records the finished blocks, once their values are flushed to the partial table"""
+	with open(path + '.partial.json.tmp', 'w') as f:
+		json.dump({'fingerprint': fingerprint, 'shape': list(shape), 'done': sorted(done)}, f)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(path + '.partial.json.tmp', path + '.partial.json')
+
+
+def removePartial(path):
+	for ext in ['.partial.json', '.partial.npy']:
+		if os.path.exists(path + ext):
+			os.remove(path + ext)
 
 
 def dictEvent(name, run,detectors):
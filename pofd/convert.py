@@ -0,0 +1,56 @@
+"""
+Converts p(det) products saved as pickles to the memory-mappable .npy
+format with a .json metadata header (see common_func.saveProduct).
+
+    python convert.py               # every product listed in setup
+    python convert.py a.p b.p ...   # the given files
+
+The pickles are left in place. Products that already have a .npy version
+are skipped.
+"""
+import os
+import sys
+import numpy as np
+
+import setup as p
+import common_func as cf
+
+
+def listedProducts():
+    """Paths of all the products described in setup"""
+    paths = []
+    for item in p.runsList + p.eventsList:
+        for key in ['pofdPath', 'pofdMargPath', 'pofdAvPath']:
+            if key in item:
+                paths.append(item[key])
+    return paths
+
+
+def convert(path):
+    """Converts the pickle at path. Returns False if there was nothing to do."""
+    if not os.path.exists(path) or os.path.exists(cf.productPaths(path)[0]):
+        return False
+    arr = np.asarray(cf.openPickle(path))
+    meta = {'nside': None,
+            'provenance': {'source': 'convert.py',
+                           'convertedFrom': os.path.basename(path)}}
+    if arr.ndim >= 1 and arr.shape[0] > 0 and arr.shape[0] % 12 == 0:
+        nside = int(np.sqrt(arr.shape[0]//12))
+        if 12*nside**2 == arr.shape[0]:
+            meta['nside'] = nside
+    if arr.ndim == 2 and arr.shape[1] == p.dsize:
+        meta['distance'] = {'min': 1.0, 'max': p.dmax, 'size': p.dsize}
+    cf.saveProduct(arr, path, **meta)
+    return True
+
+
+def main():
+    paths = sys.argv[1:] or listedProducts()
+    for path in paths:
+        if convert(path):
+            print('Converted %s' % path)
+        else:
+            print('Skipped %s' % path)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Process pool over named shared memory.
+
+Inputs are copied once into shared memory segments and outputs are
+allocated there as well. A task is a module level function called as
+func(shared, start, stop, **kwargs), where shared maps names to numpy
+views of the segments. Workers attach to the segments the first time they
+see them and write their block straight into the output arrays, so nothing
+but the function reference, the block bounds and the segment names is
+pickled.
+"""
+import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+
+
+_segments = {} # shm name -> SharedMemory attached in this worker
+
+
+def _attach(specs):
+    """Returns numpy views of the shared segments described by specs"""
+    for shmName in [s for s in _segments if s not in [v[0] for v in specs.values()]]:
+        _segments.pop(shmName).close()
+    shared = {}
+    for name, (shmName, shape, dtype) in specs.items():
+        if shmName not in _segments:
+            _segments[shmName] = shared_memory.SharedMemory(name=shmName)
+        shared[name] = np.ndarray(shape, dtype=dtype, buffer=_segments[shmName].buf)
+    return shared
+
+
+def _runBlock(task):
+    func, start, stop, specs, kwargs = task
+    func(_attach(specs), start, stop, **kwargs)
+    return start, stop
+
+
+class SharedExecutor(object):
+    """
+    Runs module level functions over blocks of an index range in a pool of
+    processes sharing their inputs and outputs.
+
+    Parameters:
+        processes: int
+            Number of worker processes. With 1 the blocks run in this process.
+    """
+    def __init__(self, processes):
+        self.processes = processes
+        self.__shm = {}
+        self.__arrays = {}
+        self.__pool = None
+        if processes > 1:
+            # workers must share this process's tracker, or each one would
+            # unlink the segments it attached to when it exits
+            resource_tracker.ensure_running()
+            self.__pool = multiprocessing.Pool(processes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __allocate(self, name, shape, dtype):
+        self.__release(name)
+        dtype = np.dtype(dtype)
+        size = max(int(np.prod(shape))*dtype.itemsize, 1)
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        self.__shm[name] = shm
+        self.__arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        return self.__arrays[name]
+
+    def __release(self, name):
+        if name in self.__shm:
+            del self.__arrays[name]
+            shm = self.__shm.pop(name)
+            shm.close()
+            shm.unlink()
+
+    def share(self, name, array):
+        """Copies an array into shared memory, replacing any array of the same name"""
+        array = np.asarray(array)
+        self.__allocate(name, array.shape, array.dtype)[...] = array
+
+    def output(self, name, shape, dtype=np.float64):
+        """Allocates a zeroed shared array for the workers to write into"""
+        out = self.__allocate(name, shape, dtype)
+        out[...] = 0
+        return out
+
+    def __getitem__(self, name):
+        return self.__arrays[name]
+
+    def map(self, func, n, blockSize, skip=(), **kwargs):
+        """
+        Calls func(shared, start, stop, **kwargs) on consecutive blocks
+        covering range(n), except those starting at an index in skip.
+        Yields (start, stop) of each block as it finishes.
+        """
+        specs = dict((name, (shm.name, self.__arrays[name].shape, self.__arrays[name].dtype.str))
+                     for name, shm in self.__shm.items())
+        tasks = [(func, i, min(i + blockSize, n), specs, kwargs) for i in range(0, n, blockSize)
+                 if i not in skip]
+        if self.__pool is None:
+            for func, start, stop, specs, kwargs in tasks:
+                func(self.__arrays, start, stop, **kwargs)
+                yield start, stop
+        else:
+            for block in self.__pool.imap_unordered(_runBlock, tasks):
+                yield block
+
+    def run(self, func, n, blockSize, skip=(), **kwargs):
+        """As map, but waits for all blocks"""
+        for block in self.map(func, n, blockSize, skip, **kwargs):
+            pass
+
+    def close(self):
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+        for name in list(self.__shm):
+            self.__release(name)
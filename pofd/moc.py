@@ -0,0 +1,141 @@
+"""
+Multi-order HEALPix maps.
+
+A multi-order map is a set of NESTED cells of different orders that tile
+the sky once, each with a row of values. Cells are labelled by their
+NUNIQ index, uniq = 4*4**order + ipix, which holds both the order and the
+pixel. The map is sampled at any position by finding the cell that
+contains it, so it can be turned into a regular map of any nside.
+
+On disk the rows are a normal product (common_func.saveProduct) and the
+uniq indices are saved next to it, see uniqPath. The metadata records the
+maximum order the map may be refined to under 'moc', and maps are opened
+at that order so that all the products of one setup share an nside
+whatever the refinement of each one.
+"""
+import numpy as np
+import healpy as hp
+import os
+
+import common_func as cf
+
+
+def uniqOf(order, ipix):
+    """NUNIQ index of the NESTED pixels ipix of the given order"""
+    return 4*np.power(4, np.asarray(order, dtype=np.int64)) + np.asarray(ipix, dtype=np.int64)
+
+
+def orderOf(uniq):
+    """Order and NESTED pixel of NUNIQ indices"""
+    uniq = np.asarray(uniq, dtype=np.int64)
+    order = np.floor(np.log2(uniq)/2.0).astype(np.int64) - 1
+    return order, uniq - 4*np.power(4, order)
+
+
+def cellCentres(uniq):
+    """RA and Dec of the centres of the cells"""
+    order, ipix = orderOf(uniq)
+    ra, dec = np.empty(order.size), np.empty(order.size)
+    for o in np.unique(order):
+        sel = order == o
+        theta, ra[sel] = hp.pix2ang(2**o, ipix[sel], nest=True)
+        dec[sel] = np.pi/2.0 - theta
+    return ra, dec
+
+
+def children(uniq):
+    """The four cells of the next order inside each cell"""
+    order, ipix = orderOf(uniq)
+    return uniqOf(order[:, None] + 1, 4*ipix[:, None] + np.arange(4)).ravel()
+
+
+def lookup(uniq, values, theta, phi):
+    """Values of the cells that contain the positions (theta, phi)"""
+    order, ipix = orderOf(uniq)
+    maxOrder = np.max(order)
+    # first pixel of each cell at the deepest order
+    starts = ipix << (2*(maxOrder - order))
+    sort = np.argsort(starts)
+    pix = hp.ang2pix(2**maxOrder, theta, phi, nest=True)
+    cell = sort[np.searchsorted(starts[sort], pix, side='right') - 1]
+    return np.asarray(values)[cell]
+
+
+def rasterise(uniq, values, nside=None):
+    """
+    Regular RING map of the multi-order map, at the nside of its finest
+    cells unless given
+    """
+    if nside is None:
+        nside = 2**int(np.max(orderOf(uniq)[0]))
+    theta, phi = hp.pix2ang(nside, np.arange(hp.nside2npix(nside)))
+    return lookup(uniq, values, theta, phi)
+
+
+def refineMask(uniq, values, tol):
+    """
+    Cells to refine: those where the values at the centre of any of the 8
+    neighbouring cells of the same order differ by more than tol (in any
+    column), an estimate of the gradient across the cell
+    """
+    values = np.asarray(values)
+    order, ipix = orderOf(uniq)
+    diff = np.zeros(order.size)
+    for o in np.unique(order):
+        sel = np.where(order == o)[0]
+        neighbours = hp.get_all_neighbours(2**o, ipix[sel], nest=True)
+        for nb in neighbours:
+            valid = nb >= 0
+            theta, phi = hp.pix2ang(2**o, nb[valid], nest=True)
+            step = np.abs(lookup(uniq, values, theta, phi) - values[sel[valid]])
+            step = step.reshape((step.shape[0], -1)).max(1)
+            diff[sel[valid]] = np.maximum(diff[sel[valid]], step)
+    return diff > tol
+
+
+def uniqPath(path):
+    """Where the uniq indices of the multi-order product saved at path are stored"""
+    return os.path.splitext(cf.productPaths(path)[0])[0] + '_uniq.npy'
+
+
+def isMoc(path):
+    return os.path.exists(uniqPath(path))
+
+
+def saveMoc(uniq, values, path, **meta):
+    """Saves the multi-order map as a product with its uniq indices, sorted by uniq"""
+    sort = np.argsort(uniq)
+    cf.makeDir(uniqPath(path))
+    with open(uniqPath(path) + '.tmp', 'wb') as f:
+        np.save(f, np.asarray(uniq, dtype=np.int64)[sort])
+    os.replace(uniqPath(path) + '.tmp', uniqPath(path))
+    cf.saveProduct(np.asarray(values)[sort], path, **meta)
+
+
+def openMoc(path):
+    """uniq indices and rows of the multi-order map saved at path"""
+    return np.load(uniqPath(path)), cf.openProduct(path)
+
+
+def mapNside(path):
+    """
+    nside of the regular map of the multi-order product saved at path:
+    2**maxOrder from its metadata, or the nside of its finest cells if it
+    was saved without it
+    """
+    meta = cf.productMeta(path)
+    if 'moc' in meta:
+        return 2**int(meta['moc']['maxOrder'])
+    return 2**int(np.max(orderOf(np.load(uniqPath(path)))[0]))
+
+
+def openMap(path, nside=None):
+    """
+    The product saved at path as a regular RING map. Multi-order maps are
+    rasterised (see rasterise) at mapNside unless nside is given, other
+    products are opened as they are.
+    """
+    if isMoc(path):
+        uniq, values = openMoc(path)
+        return rasterise(uniq, values, mapNside(path) if nside is None else nside)
+    return cf.openProduct(path)
@@ -1,11 +1,8 @@
 import numpy as np
 import healpy as hp
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from pathos.multiprocessing import ProcessingPool
 import pickle
 import joblib
+import hashlib
 import datetime
 import lal
 import time
@@ -21,6 +18,39 @@ import sys
 
 import setup as p
 import common_func as cf
+import snr
+import rings
+import survival
+import executor
+import reweight
+import moc
+import sketch
+
+
+def pofdBlock(shared, start, stop, gmst):
+    """
+    Worker for Pofd: p(det|dist) for the sky positions start:stop of
+    shared['ra'], shared['dec'], written into shared['pofd']
+    """
+    network = list(zip(shared['tensors'], shared['factors']))
+    rho = snr.networkSnrSquared(shared['ra'][start:stop], shared['dec'][start:stop], gmst,
+                                shared['inc'], shared['psi'], network)
+    survivalFunc = survival.ncxSurvival(p.snrThrComb**2, 4, p.survivalTol)
+    d = 1.0/(np.linspace(1.0, p.dmax, p.dsize)*p.Mpc)**2
+    for k in range(rho.shape[0]):
+        shared['pofd'][start + k] = np.sum(survivalFunc(np.outer(rho[k], d)),0)/rho.shape[1]
+
+
+def sketchBlock(shared, start, stop, gmst):
+    """
+    Worker for Pofd: quantile sketch of the SNR**2 at 1 Mpc for the sky
+    positions start:stop, written into shared['sketch']
+    """
+    network = list(zip(shared['tensors'], shared['factors']))
+    rho = snr.networkSnrSquared(shared['ra'][start:stop], shared['dec'][start:stop], gmst,
+                                shared['inc'], shared['psi'], network)/p.Mpc**2
+    shared['sketch'][start:stop] = sketch.quantileSketch(rho, p.sketchSize)
+
 
 class Pofd(object):
     """Generates the p(detection|omega, dist), assumes the power law distribution of masses"""
@@ -30,11 +60,14 @@ class Pofd(object):
         self.__pixArr = range(self.__nPix)
         theta, phi = hp.pix2ang(p.nsideDet,self.__pixArr)
         self.__ra, self.__dec = phi, np.pi/2 - theta
+        np.random.seed(p.seed) # same samples on every run, so partial results can be resumed
         q = np.random.rand(p.nSamp)
         self.__inc = np.arccos(2.0*q - 1.0) # Uniform in cos(inclination)
         self.__psi = np.random.rand(p.nSamp)*2.0*np.pi # Uniform in polarisation
         self.__m1, self.__m2 = self.__massDist() # Power law distribution for m1, m2
         self.mtotMin = 2*p.mmin*p.mSolar
+        self.__numCache = {}
+        self.__cache = cf.productCache(p.cacheBytes)
 
     def __massDist(self):
         """ Minimum mass assumed to be 5 M_solar, total mass always less than 100 M_solar. Note this is outdated with O3a data"""
@@ -54,322 +87,457 @@ class Pofd(object):
         lim = min(m1, (p.mmax-m1))
         return scipy.stats.uniform.rvs(loc=p.mmin, scale=(lim - p.mmin))
 
-    def setPSD(self, path, name, det): ### needs editing to include virgo
+    def setPSD(self, path, det):
         """
-        Set up the PSD for LIGO Hanford and Livingston. Returns interpolated PSD and fmin
-        Note: will want to include the Virgo PSD at a later date
-        Optional: Plot the PSD if 'plot=True'
+        Set up the PSD of a detector (see common_func.readPSD for det).
+        Returns the interpolated amplitude spectral density and fmin
         """
-        if det == 'L1H1':
-            PSDdata = np.genfromtxt(path) 
-            freq_samples = PSDdata[:, 0]
-            psd_data = PSDdata[:, 1]
-        elif det =='V1':
-            PSDdata = np.genfromtxt(path) 
-            freq_samples = PSDdata[:, 0]
-            psd_data = PSDdata[:, 1]
-        else:
-            PSDdata = np.genfromtxt(path, names=True)
-            freq_samples = PSDdata['Freq']
-            psd_data = np.sqrt(PSDdata[det])
-
+        freq_samples, psd_data = cf.readPSD(path, det)
         fmin = np.min(freq_samples)
         PSD = scipy.interpolate.interp1d(freq_samples,psd_data)
-        plt.figure()
-        title = 'PSD for run %s' %(name)
-        path = p.PSDpath %(name)
-        plt.loglog(freq_samples,PSD(freq_samples))
-        plt.savefig(path, dpi=p.dpi)
-        plt.close('all')
         return PSD, fmin
 
-    def __antennaResponse(self, gmst, RA, Dec, psi, det):
+    def __numFmax(self, pathPSD, det):
+        """
+        Generate the interpolated function num_fmax as a function of f_max.
+        The integral is accumulated in one pass over a grid numRefine times
+        finer than the output points. The curve is cached on disk, keyed by
+        the content of the PSD file, the PSD column and mtotMin.
+        """
+        key = '%s %s %r %d %d' %(cf.fileHash(pathPSD), det, self.mtotMin, p.nNum, p.numRefine)
+        key = hashlib.sha1(key.encode()).hexdigest()
+        if key not in self.__numCache:
+            cachePath = p.numCachePath %(key)
+            if os.path.exists(cachePath):
+                fmaxArr, numFmax = cf.openPickle(cachePath)
+            else:
+                PSD, fmin = self.setPSD(pathPSD, det)
+                fmax = snr.fmax(self.mtotMin)
+                f = np.linspace(fmin, fmax, (p.nNum - 1)*p.numRefine + 1)
+                I = np.power(f,-7.0/3.0)/(PSD(f)**2)
+                numFmax = scipy.integrate.cumulative_trapezoid(I, f, initial=0)[::p.numRefine]
+                fmaxArr = f[::p.numRefine]
+                cf.savePickle((fmaxArr, numFmax), cachePath)
+            self.__numCache[key] = scipy.interpolate.interp1d(fmaxArr, numFmax)
+        return self.__numCache[key]
+
+    def __network(self, spec):
         """
-        Compute detector response to signal with specific ra, dec, psi, and time
+        (response tensor, mass factor) pairs for each (detector, PSD file, PSD column)
+        in spec. Detectors sharing a PSD share the num(fmax) interpolant.
         """
-        detMap = {'H1': lal.LALDetectorIndexLHODIFF,
-                  'H2': lal.LALDetectorIndexLHODIFF,
-                  'L1': lal.LALDetectorIndexLLODIFF,
-                  'G1': lal.LALDetectorIndexGEO600DIFF,
-                  'V1': lal.LALDetectorIndexVIRGODIFF,
-                  'T1': lal.LALDetectorIndexTAMA300DIFF,
-                  'AL1': lal.LALDetectorIndexLLODIFF,
-                  'AH1': lal.LALDetectorIndexLHODIFF,
-                  'AV1': lal.LALDetectorIndexVIRGODIFF,
-                  'E1': lal.LALDetectorIndexE1DIFF,
-                  'E2': lal.LALDetectorIndexE2DIFF,
-                  'E3': lal.LALDetectorIndexE3DIFF,}
+        interpols = {}
+        network = []
+        for det, path, column in spec:
+            if (path, column) not in interpols:
+                interpols[(path, column)] = self.__numFmax(path, column)
+            network.append((snr.detectorTensor(det),
+                            snr.massFactor(self.__m1, self.__m2, interpols[(path, column)])))
+        return network
+
+    def __lazyNetwork(self, spec):
+        """Function returning self.__network(spec), built on the first call"""
+        built = []
+        def network():
+            if not built:
+                built.append(self.__network(spec))
+            return built[0]
+        return network
+
+    def __runSpec(self, item):
+        """Detector network for a run, using the analytic PSDs"""
+        spec = [('H1', item['psdPath'], 'L1H1'), ('L1', item['psdPath'], 'L1H1')]
+        if item['run'] != 'O1':
+            spec.append(('V1', item['VpsdPath'], 'V1'))
+        return spec
+
+    def __eventSpec(self, item):
+        """
+        Detector network for an event. Uses the PSDs released with the event,
+        or the analytic PSDs of its run if p.eventPSD == 'run'
+        """
+        if item['detectors'] not in ['H1L1V1', 'H1L1', 'H1V1', 'L1V1']:
+            raise Exception("Detector config for %s is incorrect, check it's set correctly in the event list!"%(item['name']))
+        dets = [item['detectors'][i:i+2] for i in range(0, len(item['detectors']), 2)]
+        if p.eventPSD == 'run':
+            run = [r for r in p.runsList if r['run'] == item['run']][0]
+            return [(det, run['VpsdPath'], 'V1') if det == 'V1' else (det, run['psdPath'], 'L1H1')
+                    for det in dets]
+        return [(det, item['psdPath'], det + '_PSD') for det in dets]
+
+    def __specKey(self, spec):
+        """Identifies a network by its detectors and the content of their PSDs"""
+        return tuple((det, cf.fileHash(path), column) for det, path, column in spec)
+
+    def __fingerprint(self, ra, dec, network, gmst):
+        """Hash of everything a p(det) table depends on, to check a partial result can be resumed"""
+        h = hashlib.sha1()
+        for arr in [ra, dec, self.__inc, self.__psi, self.__d] + [a for pair in network for a in pair]:
+            h.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+        h.update(repr((gmst, p.snrThrComb, p.survivalTol, p.pixBlock)).encode())
+        return h.hexdigest()
+
+    def __productFingerprint(self, spec, gmst, shifted):
+        """
+        Hash of everything a saved product depends on: the pixels, the
+        samples, the PSDs of the network and the settings. Stored in the
+        product metadata so finished tables are not computed again
+        """
+        h = hashlib.sha1()
+        for arr in [self.__ra, self.__dec, self.__inc, self.__psi, self.__m1, self.__m2, self.__d]:
+            h.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+        h.update(repr((self.__specKey(spec), gmst, shifted, p.snrThrComb, p.survivalTol,
+                       p.mocMaxOrder, p.mocTol, p.siderealOversample, p.sketchSize)).encode())
+        return h.hexdigest()
+
+    def __finished(self, path, fingerprint):
+        """Whether the product saved at path was computed from the inputs of fingerprint"""
         try:
-            detector = detMap[det]
-        except KeyError:
-            raise(ValueError, 'ERROR. Key %s is not a valid detector name.' % (det))
-        # Get detector
-        detval = lal.CachedDetectors[detector]
-        response = detval.response
-        fp, fc = lal.ComputeDetAMResponse(response, RA, Dec, psi, gmst)
-        return fp, fc
-
-    def __fmax(self, m):
-        """ Returns maximum frequency given the total mass"""
-        return 1/(np.power(6.0,3.0/2.0)*np.pi*m)*p.c**3/p.G
-
-    def __numFmax(self, pathPSD, name, det):
+            return cf.productMeta(path).get('fingerprint') == fingerprint
+        except (IOError, ValueError):
+            return False
+
+    def __snrFinished(self, pofdPath, fingerprint):
+        path = reweight.snrPath(pofdPath)
+        return os.path.exists(path) and cf.openPickle(path).get('fingerprint') == fingerprint
+
+    def __pofdTable(self, network, gmst, path, ra=None, dec=None):
+        """
+        p(det|dist, RA, Dec) on the pixel centres, or on the given sky
+        positions, shape (nPix, dsize). Blocks of pixels are computed by the
+        workers of self.__executor. Finished blocks are written to a partial
+        result next to path, so an interrupted computation resumes where it
+        stopped. Remove it with cf.removePartial once the table is saved.
+        """
+        if ra is None:
+            ra, dec = self.__ra, self.__dec
+        shape = (len(ra), p.dsize)
+        fingerprint = self.__fingerprint(ra, dec, network, gmst)
+        table, done = cf.openPartial(path, shape, fingerprint)
+        ex = self.__executor
+        ex.share('ra', ra)
+        ex.share('dec', dec)
+        ex.share('tensors', [tensor for tensor, factor in network])
+        ex.share('factors', [factor for tensor, factor in network])
+        ex.output('pofd', shape)
+        for start, stop in ex.map(pofdBlock, len(ra), p.pixBlock, skip=done, gmst=gmst):
+            table[start:stop] = ex['pofd'][start:stop]
+            table.flush()
+            done.add(start)
+            cf.savePartialState(path, shape, fingerprint, done)
+        return np.array(table)
+
+    def __levelPath(self, path, order):
+        """Where the partial result of one refinement level of __mocTable is kept"""
+        return '%s.order%d' %(path, order)
+
+    def __mocTable(self, network, gmst, path):
+        """
+        p(det|dist, RA, Dec) as a multi-order map. Starts from the pixels of
+        nsideDet and splits the cells of the last order where p(det) differs
+        from a neighbouring cell by more than p.mocTol, until no cell needs
+        it or the order reaches p.mocMaxOrder. The Monte Carlo samples are
+        shared by all pixels, so the noise is correlated across the sky and
+        the differences to neighbours measure the actual gradient.
+        Returns the uniq indices and the table of the cells. The partial
+        result of every level is kept until __saveTable has saved the map,
+        so an interrupted refinement resumes without redoing any level.
+        """
+        order = int(np.log2(p.nsideDet))
+        uniq = moc.uniqOf(order, np.arange(hp.nside2npix(p.nsideDet)))
+        ra, dec = moc.cellCentres(uniq)
+        table = self.__pofdTable(network, gmst, self.__levelPath(path, order), ra, dec)
+        while order < p.mocMaxOrder:
+            refine = moc.refineMask(uniq, table, p.mocTol) & (moc.orderOf(uniq)[0] == order)
+            if not np.any(refine):
+                break
+            order += 1
+            print('Refining %d cells to order %d' %(np.sum(refine), order))
+            new = moc.children(uniq[refine])
+            ra, dec = moc.cellCentres(new)
+            newTable = self.__pofdTable(network, gmst, self.__levelPath(path, order), ra, dec)
+            uniq = np.concatenate([uniq[~refine], new])
+            table = np.concatenate([table[~refine], newTable])
+        return uniq, table
+
+    def __saveTable(self, network, gmst, path, meta):
+        """Computes and saves the table at path, as a multi-order map if p.mocMaxOrder is set"""
+        if p.mocMaxOrder is None:
+            table = self.__pofdTable(network, gmst, path)
+            self.__saveRegular(table, path, meta)
+            cf.removePartial(path)
+        else:
+            uniq, table = self.__mocTable(network, gmst, path)
+            meta['moc'] = {'minOrder': int(np.log2(p.nsideDet)), 'maxOrder': p.mocMaxOrder, 'tol': p.mocTol}
+            moc.saveMoc(uniq, table, path, **meta)
+            for order in range(int(np.log2(p.nsideDet)), p.mocMaxOrder + 1):
+                cf.removePartial(self.__levelPath(path, order))
+        return table
+
+    def __saveRegular(self, table, path, meta):
+        """
+        Saves a table on the pixels of nsideDet. With p.mocMaxOrder set it is
+        saved as a multi-order map of a single order, so that it is opened
+        at the same nside as the refined tables
+        """
+        if p.mocMaxOrder is None:
+            if moc.isMoc(path):
+                os.remove(moc.uniqPath(path))
+            cf.saveProduct(table, path, **meta)
+        else:
+            order = int(np.log2(p.nsideDet))
+            uniq = moc.uniqOf(order, hp.ring2nest(p.nsideDet, np.arange(self.__nPix)))
+            meta['moc'] = {'minOrder': order, 'maxOrder': p.mocMaxOrder, 'tol': p.mocTol}
+            moc.saveMoc(uniq, table, path, **meta)
+
+    def __siderealPath(self, key):
+        return p.siderealPartialPath %(hashlib.sha1(repr(key).encode()).hexdigest())
+
+    def __siderealTable(self, network, key):
+        """
+        p(det|dist) at gmst = 0 on the sidereal-aligned grid of rings.ringGrid.
+        Its partial result is kept until every event map of the network is
+        saved, remove it with cf.removePartial(self.__siderealPath(key))
         """
-        Generate the interpolated function num_fmax as a function of f_max
+        ra, dec = rings.ringGrid(p.nsideDet, p.siderealOversample)
+        return self.__pofdTable(network, 0.0, self.__siderealPath(key), ra, dec)
+
+    def __saveSnr(self, network, gmst, pofdPath, fingerprint):
         """
-        PSD, fmin = self.setPSD(pathPSD, name, det)
-        def I(f):
-            return np.power(f,-7.0/3.0)/(PSD(f)**2)
-        fmax = self.__fmax(self.mtotMin)
-        fmaxArr = np.linspace(fmin, fmax, p.nNum)
-        
-        pool = ProcessingPool(p.pools)
-
-        def loopKiller(k):
-            return scipy.integrate.quad(I, fmin, fmaxArr[k], epsabs=0,
-                                        epsrel=1.49e-4, limit=10000)[0]
-
-        loopOut = pool.map(loopKiller, range(p.nNum))
-        numFmax = np.array(loopOut)
-        return scipy.interpolate.interp1d(fmaxArr, numFmax)                              
-        
-    def __snrSquared(self, RA, Dec, inc, psi, m1, m2, detector, gmst, interpolNum):
-        """The optimal SNR**2 for one detector, marginalising over sky
-        location, inclination, polarisation, mass
+        Stores the per-sample SNR**2 at 1 Mpc of every pixel, with the masses
+        and the density they were drawn from, for reweight.reweightPofd
         """
-        fplus,fcross = self.__antennaResponse(gmst, RA, Dec, psi, detector)
-        mtot = m1+m2
-        mchirp = np.power(m1*m2,3.0/5.0)/np.power(mtot,1.0/5.0)
-        A = float(np.sqrt(fplus**2*(1.0+np.cos(inc)**2)**2 + fcross**2*4.0*np.cos(inc)**2) \
-                * np.sqrt(5.0*np.pi/96.0)*np.power(np.pi,-7.0/6.0) * np.power(mchirp,5.0/6.0))	# (dofz(z,H0)*Mpc)
-        fmax = self.__fmax(mtot)
-        num = interpolNum(fmax)
-        return 4.0*A**2*num*np.power(p.G,5.0/3.0)/p.c**3.0
+        rho = np.vstack([snr.networkSnrSquared(self.__ra[i:i + p.pixBlock], self.__dec[i:i + p.pixBlock], gmst,
+                                               self.__inc, self.__psi, network)/p.Mpc**2
+                         for i in range(0, self.__nPix, p.pixBlock)])
+        m1, m2 = self.__m1/p.mSolar, self.__m2/p.mSolar
+        data = {'rho': rho.astype(np.float32),
+                'm1': m1,
+                'm2': m2,
+                'logq': reweight.massLogDensity(m1, m2, p.alpha, p.mmin, p.mmax),
+                'd': self.__d,
+                'threshold': p.snrThrComb**2,
+                'nside': p.nsideDet,
+                'gmst': gmst,
+                'fingerprint': fingerprint,}
+        cf.savePickle(data, reweight.snrPath(pofdPath))
+
+    def __saveSketch(self, network, gmst, pofdPath, fingerprint):
+        """Stores the quantile sketch of the SNR**2 of every pixel, see sketch.PofdSketch"""
+        ex = self.__executor
+        ex.share('ra', self.__ra)
+        ex.share('dec', self.__dec)
+        ex.share('tensors', [tensor for tensor, factor in network])
+        ex.share('factors', [factor for tensor, factor in network])
+        ex.output('sketch', (self.__nPix, p.sketchSize))
+        ex.run(sketchBlock, self.__nPix, p.pixBlock, gmst=gmst)
+        cf.saveProduct(ex['sketch'].astype(np.float32), sketch.sketchPath(pofdPath),
+                       nside=p.nsideDet, threshold=p.snrThrComb**2, units='SNR**2 at 1 Mpc',
+                       weights=list(sketch.sketchWeights(p.nSamp, p.sketchSize)), fingerprint=fingerprint,
+                       provenance={'source': 'pofd.py', 'gmst': gmst, 'nSamp': p.nSamp, 'seed': p.seed})
+
+    def __productMeta(self, name, spec, gmst, fingerprint):
+        """Metadata header of a p(det) table"""
+        return {'nside': p.nsideDet,
+                'fingerprint': fingerprint,
+                'distance': {'min': 1.0, 'max': p.dmax, 'size': p.dsize},
+                'provenance': {'source': 'pofd.py',
+                               'name': name,
+                               'gmst': gmst,
+                               'detectors': [det for det, path, column in spec],
+                               'psd': [os.path.basename(path) for det, path, column in spec],
+                               'nSamp': p.nSamp,
+                               'seed': p.seed,
+                               'siderealShift': p.siderealShift,}}
 
     def generatePofD_DLRADec_events(self):
         """Calculate the survival function at every point on the skymap."""
+        with executor.SharedExecutor(p.pools) as self.__executor:
+            self.__executor.share('inc', self.__inc)
+            self.__executor.share('psi', self.__psi)
+            self.__generate()
+
+    def __saveExtras(self, network, gmst, pofdPath, fingerprint):
+        """
+        Stores the SNRs and sketch of the table at pofdPath if they are asked
+        for and missing. network is called to build the network when needed
+        """
+        if p.storeSnr and not self.__snrFinished(pofdPath, fingerprint):
+            self.__saveSnr(network(), gmst, pofdPath, fingerprint)
+        if p.storeSketch and not self.__finished(sketch.sketchPath(pofdPath), fingerprint):
+            self.__saveSketch(network(), gmst, pofdPath, fingerprint)
+
+    def __generate(self):
+        """
+        Generates and saves the p(det) tables of all runs and events. Tables
+        whose saved metadata matches their inputs are skipped, so a restart
+        only computes what is missing
+        """
         # Generate podf(distance, sky pos) from the analytic PSD for a run
         # Whe generating pofd for runs assume that gmst = 0
         gmst = 0
-        pool = ProcessingPool(p.pools)
         for item in p.runsList:
-            if item['run'] == 'O1':
-                interpolNum = self.__numFmax(item['psdPath'], item['run'], 'L1H1')
-            else:
-                interpolNum = self.__numFmax(item['psdPath'], item['run'], 'L1H1')
-                interpolNum_V = self.__numFmax(item['VpsdPath'], item['run'], 'V1')
-
-            print('Computing p(det|dist, RA, Dec) for run %s.' %(item['run']))
-            print('Started at:', datetime.datetime.time(datetime.datetime.now()))
-
-            def loopKiller(k):
-                rho = np.zeros((p.nSamp, 1))
-                test = np.zeros((p.nSamp, 1))
-                for n in range(p.nSamp):
-                    if item['run'] == 'O1':
-                        rho[n] = self.__snrSquared(self.__ra[k], self.__dec[k], self.__inc[n], \
-                                               self.__psi[n], self.__m1[n], self.__m2[n], 'H1', gmst, interpolNum) \
-                                                + self.__snrSquared(self.__ra[k], self.__dec[k], self.__inc[n], \
-                                                self.__psi[n], self.__m1[n], self.__m2[n], 'L1', gmst, interpolNum)
-                    else:                                                                           
-                        rho[n] = self.__snrSquared(self.__ra[k], self.__dec[k], self.__inc[n], \
-                                               self.__psi[n], self.__m1[n], self.__m2[n], 'H1', gmst, interpolNum) \
-                                                + self.__snrSquared(self.__ra[k], self.__dec[k], self.__inc[n], \
-                                                self.__psi[n], self.__m1[n], self.__m2[n], 'L1', gmst, interpolNum) \
-                                                + self.__snrSquared(self.__ra[k], self.__dec[k], self.__inc[n], \
-                                               self.__psi[n], self.__m1[n], self.__m2[n], 'V1', gmst, interpolNum_V)
-
-                d = (self.__d.reshape((p.dsize, 1))).transpose()
-                d = 1.0/(d*p.Mpc)**2
-                survival = np.matmul(rho, d)
-                survival = scipy.stats.ncx2.sf(p.snrThrComb**2, 4, survival)
-                return np.sum(survival,0)/p.nSamp
-
-            # loopOut = pool.map(loopKiller, range(self.__nPix)) # Optional multiprocessing; causing some conflict with dill
-            
-            loopOut = [loopKiller(i) for i in range(self.__nPix)]  
-            
-            pofd_dLRADec = np.vstack(loopOut)
-            cf.savePickle(pofd_dLRADec, item['pofdPath'])
-            print('Actual end:', datetime.datetime.time(datetime.datetime.now()))
-            print(pofd_dLRADec.shape)
-        pool.close()
-        pool.join()
-        pool.clear()
-        # Generate pofd(distance, sky pos) form the actual PSD for a run            
-        # When generating pofd for events set gmst to the time of the event
-        pool = ProcessingPool(p.pools)
-        for item in p.eventsList:  
-            if item['detectors'] == 'H1L1V1': 
-                interpolNum_L1 = self.__numFmax(item['psdPath'], str('L1' + item['name']), 'L1_PSD')
-                interpolNum_H1 = self.__numFmax(item['psdPath'], str('H1' + item['name']), 'H1_PSD')
-                interpolNum_V1 = self.__numFmax(item['psdPath'], str('V1' + item['name']), 'V1_PSD')
-            elif item['detectors'] == 'H1L1':
-                interpolNum_L1 = self.__numFmax(item['psdPath'], str('L1' + item['name']), 'L1_PSD')
-                interpolNum_H1 = self.__numFmax(item['psdPath'], str('H1' + item['name']), 'H1_PSD')
-            elif item['detectors'] == 'H1V1':
-                interpolNum_V1 = self.__numFmax(item['psdPath'], str('V1' + item['name']), 'V1_PSD')
-                interpolNum_H1 = self.__numFmax(item['psdPath'], str('H1' + item['name']), 'H1_PSD')
-            elif item['detectors'] == 'L1V1':
-                interpolNum_V1 = self.__numFmax(item['psdPath'], str('V1' + item['name']), 'V1_PSD')
-                interpolNum_L1 = self.__numFmax(item['psdPath'], str('L1' + item['name']), 'L1_PSD')
+            spec = self.__runSpec(item)
+            network = self.__lazyNetwork(spec)
+            fingerprint = self.__productFingerprint(spec, gmst, False)
+            if self.__finished(item['pofdPath'], fingerprint):
+                print('p(det|dist, RA, Dec) for run %s is up to date.' %(item['run']))
             else:
-                raise Exception("Detector config for %s is incorrect, check it's set correctly in the event list!"%(item['name']))
-        
-            data = cf.loadSamples(item['postSamplePath'])
+                print('Computing p(det|dist, RA, Dec) for run %s.' %(item['run']))
+                print('Started at:', datetime.datetime.time(datetime.datetime.now()))
+                pofd_dLRADec = self.__saveTable(network(), gmst, item['pofdPath'],
+                                                self.__productMeta(item['run'], spec, gmst, fingerprint))
+                print('Actual end:', datetime.datetime.time(datetime.datetime.now()))
+                print(pofd_dLRADec.shape)
+            self.__saveExtras(network, gmst, item['pofdPath'], fingerprint)
+
+        # Generate pofd(distance, sky pos) form the actual PSD for a run
+        # When generating pofd for events set gmst to the time of the event.
+        # With p.siderealShift the Monte Carlo is done once per network at
+        # gmst = 0 and each event map is a rotation of it about the pole.
+        # Events are grouped by network so only one base table is held.
+        # Only events with the same PSDs share a base table, which needs
+        # p.eventPSD == 'run'. An event alone on its network is computed
+        # directly, as the oversampled base table would cost more.
+        # The shifted maps are on the regular grid, so p.siderealShift
+        # takes precedence over p.mocMaxOrder for the events. They are still
+        # saved as single order maps, opened at 2**p.mocMaxOrder like the
+        # runs.
+        # The base table is only computed for a network that has an event
+        # left to save, and its partial result is removed after the last one.
+        specs = [self.__eventSpec(item) for item in p.eventsList]
+        keys = [self.__specKey(spec) for spec in specs] if p.siderealShift else [None]*len(specs)
+        order = sorted(range(len(specs)), key=lambda i: str(keys[i]))
+        networkKey, baseKey, baseTable = None, None, None
+        for n, i in enumerate(order):
+            item, spec, key = p.eventsList[i], specs[i], keys[i]
             gpsTime = float(item['time'])
             gmst = lal.GreenwichMeanSiderealTime(gpsTime)
+            shifted = p.siderealShift and keys.count(key) > 1
+            if not shifted or key != networkKey:
+                networkKey, network = key, self.__lazyNetwork(spec)
+            fingerprint = self.__productFingerprint(spec, gmst, shifted)
 
-            print('Computing p(det|dist, RA, Dec) for event %s.' %(item['name']))
-            print('Started at:', datetime.datetime.time(datetime.datetime.now()))
-                                
-            def loopKiller(k):
-                rho = np.zeros((p.nSamp, 1))
-                test = np.zeros((p.nSamp, 1))
-                for n in range(p.nSamp):                    
-                    if item['detectors'] == 'H1V1L1':
-                        rho[n] = self.__snrSquared(self.__ra[k], self.__dec[k], self.__inc[n], \
-                                        self.__psi[n], self.__m1[n], self.__m2[n], 'H1', gmst, interpolNum_L1) \
-                                        + self.__snrSquared(self.__ra[k], self.__dec[k], self.__inc[n], \
-                                        self.__psi[n], self.__m1[n], self.__m2[n], 'L1', gmst, interpolNum_H1) \
-                                        + self.__snrSquared(self.__ra[k], self.__dec[k], self.__inc[n], \
-                                        self.__psi[n], self.__m1[n], self.__m2[n], 'V1', gmst, interpolNum_V1) 
-                    elif item['detectors'] == 'H1L1':
-                        rho[n] = self.__snrSquared(self.__ra[k], self.__dec[k], self.__inc[n], \
-                                        self.__psi[n], self.__m1[n], self.__m2[n], 'H1', gmst, interpolNum_L1) \
-                                        + self.__snrSquared(self.__ra[k], self.__dec[k], self.__inc[n], \
-                                        self.__psi[n], self.__m1[n], self.__m2[n], 'L1', gmst, interpolNum_H1) 
-                    elif item['detectors'] == 'H1V1':
-                        rho[n] = self.__snrSquared(self.__ra[k], self.__dec[k], self.__inc[n], \
-                                        self.__psi[n], self.__m1[n], self.__m2[n], 'H1', gmst, interpolNum_H1) \
-                                        + self.__snrSquared(self.__ra[k], self.__dec[k], self.__inc[n], \
-                                        self.__psi[n], self.__m1[n], self.__m2[n], 'V1', gmst, interpolNum_V1) 
-                    elif item['detectors'] == 'L1V1':
-                        rho[n] = self.__snrSquared(self.__ra[k], self.__dec[k], self.__inc[n], \
-                                        self.__psi[n], self.__m1[n], self.__m2[n], 'L1', gmst, interpolNum_L1) \
-                                        + self.__snrSquared(self.__ra[k], self.__dec[k], self.__inc[n], \
-                                        self.__psi[n], self.__m1[n], self.__m2[n], 'V1', gmst, interpolNum_V1)
-
-                d = (self.__d.reshape((p.dsize, 1))).transpose()
-                d = 1.0/(d*p.Mpc)**2
-                survival = np.matmul(rho, d)
-                survival = scipy.stats.ncx2.sf(p.snrThrComb**2, 4, survival)
-                return np.sum(survival,0)/p.nSamp
-
-            #loopOut = pool.map(loopKiller, range(self.__nPix))
-            loopOut = [loopKiller(i) for i in range(self.__nPix)] 
-       	    pofd_dLRADec = np.vstack(loopOut)
-            cf.savePickle(pofd_dLRADec, item['pofdPath'])
-            print('Actual end:', datetime.datetime.time(datetime.datetime.now()))
-            print(pofd_dLRADec.shape)
-        pool.close()
-        pool.join()
-        pool.clear()
-        
-        # TO DO: make a loop for each event, except add gmst to get different antenna responses
-    def plotSamples(self):
+            if self.__finished(item['pofdPath'], fingerprint):
+                print('p(det|dist, RA, Dec) for event %s is up to date.' %(item['name']))
+            else:
+                print('Computing p(det|dist, RA, Dec) for event %s.' %(item['name']))
+                print('Started at:', datetime.datetime.time(datetime.datetime.now()))
+                meta = self.__productMeta(item['name'], spec, gmst, fingerprint)
+                if shifted:
+                    if key != baseKey:
+                        baseKey = key
+                        baseTable = self.__siderealTable(network(), key)
+                    pofd_dLRADec = rings.ringShift(baseTable, p.nsideDet, gmst, p.siderealOversample)
+                    self.__saveRegular(pofd_dLRADec, item['pofdPath'], meta)
+                else:
+                    pofd_dLRADec = self.__saveTable(network(), gmst, item['pofdPath'], meta)
+                print('Actual end:', datetime.datetime.time(datetime.datetime.now()))
+                print(pofd_dLRADec.shape)
+            self.__saveExtras(network, gmst, item['pofdPath'], fingerprint)
+            if shifted and (n + 1 == len(order) or keys[order[n + 1]] != key):
+                cf.removePartial(self.__siderealPath(key))
+
+    def psdTasks(self):
+        """Render tasks for the PSD of every detector of the runs and events"""
+        import render # pyplot is only imported when something is drawn
+        named = [(item['run'], self.__runSpec(item)) for item in p.runsList] \
+                + [(item['name'], self.__eventSpec(item)) for item in p.eventsList]
+        tasks, seen = [], set()
+        for name, spec in named:
+            for det, path, column in spec:
+                plotName = name if column in ['L1H1', 'V1'] else str(det + name)
+                if plotName in seen:
+                    continue
+                seen.add(plotName)
+                freq, asd = cf.readPSD(path, column)
+                tasks.append((render.drawPsd, (p.PSDpath %(plotName), freq, asd)))
+        return tasks
+
+    def samplesTasks(self):
         """
-        Plot to make sure all parameters are following the expected distribution,
+        Render task to make sure all parameters are following the expected distribution,
         including the RA and Dec generated from healpy
         """
-        fig,ax = plt.subplots(2, 3)
-        plt.subplots_adjust(wspace= 0.7)
-        plt.suptitle('Distribution of samples')
-        ax[0][0].hist(self.__ra, bins='auto')
-        ax[0][0].set_xlabel('$\\alpha$')
-        ax[0][0].set_ylabel('p($\\alpha$)')
-
-        ax[0][1].hist(self.__dec, bins='auto')
-        ax[0][1].set_xlabel('$\delta$')
-        ax[0][1].set_ylabel('p($\delta$)')
-    
-        ax[0][2].hist(self.__inc, bins='auto')
-        ax[0][2].set_xlabel('$\iota$')
-        ax[0][2].set_ylabel('p($\iota$)')
-
-        ax[1][0].hist(self.__psi, bins='auto')
-        ax[1][0].set_xlabel('$\psi$')
-        ax[1][0].set_ylabel('p($\psi$)')
-
-        ax[1][1].hist(self.__m1/p.mSolar, bins='auto')
-        ax[1][1].set_xlabel('$M_1 (M_{solar})$')
-        ax[1][1].set_ylabel('p($M_1$)')
-
-        ax[1][2].hist(self.__m2/p.mSolar, bins='auto')
-        ax[1][2].set_xlabel('$M_2 (M_{solar})$')
-        ax[1][2].set_ylabel('p($M_2$)')
-
-        plt.savefig(p.objSamplesPath, dpi=p.dpi)
-        plt.close('all')
-
-    def plotSurvival(self):
-        """Plots the survival graph as a function of distance for each pixel, for each run"""
+        import render
+        panels = [(self.__ra, '$\\alpha$', 'p($\\alpha$)'),
+                  (self.__dec, '$\\delta$', 'p($\\delta$)'),
+                  (self.__inc, '$\\iota$', 'p($\\iota$)'),
+                  (self.__psi, '$\\psi$', 'p($\\psi$)'),
+                  (self.__m1/p.mSolar, '$M_1 (M_{solar})$', 'p($M_1$)'),
+                  (self.__m2/p.mSolar, '$M_2 (M_{solar})$', 'p($M_2$)')]
+        return [(render.drawSamples, (p.objSamplesPath, panels))]
+
+    def survivalTasks(self):
+        """Render tasks of the survival graph as a function of distance for a set of pixels, for each run"""
+        import render
         N = 2  # nside to generate pixel centers and later convert to pixels on a detailed map
         if p.nsideDet > N:
             arr = np.arange(hp.nside2npix(N))
             theta, phi = hp.pix2ang(N, arr)
             pixPlot = hp.ang2pix(p.nsideDet, theta, phi)
         else:
-            pixPlot = self.__pixArr
+            pixPlot = np.arange(self.__nPix)
 
+        tasks = []
         for item in p.runsList:
-            plt.rcParams['font.serif']='Times New Roman' # Text font
-            plt.rcParams['font.family']='serif'
-            plt.rcParams['font.size']=8
-            plt.rcParams['text.usetex']=False
-            plt.rcParams['mathtext.fontset']='cm' #Computer Modern font
-            figwidth=3.4 # PRD column width in inches
-            aspect = 0.75 # Aspect ratio
-
-            figheight = aspect*figwidth
-            plt.figure(figsize=(figwidth,figheight),dpi=240)
-            pofd_dLRADec = cf.openPickle(item['pofdPath'])
-            survivalFunc = scipy.interpolate.interp1d(self.__d, pofd_dLRADec, bounds_error=False, fill_value=1e-10)
-            for i in pixPlot:
-                plt.plot(self.__d, survivalFunc(self.__d)[i,:])
-            plt.xlabel('$d_L$ (Mpc)')
-            plt.ylabel('$p(D|d_L,t = {0}, I)$'.format(item['run']))
-            if item['run'] == 'O3b':
-                plt.xlim(xmin=0, xmax=4000)
-            else:
-                plt.xlim(xmin=0, xmax=2000)
+            # the table is on the plotted distance grid, so its rows are the curves
+            curves = np.array(self.__cache.get(item['pofdPath'], self.__openMap)[pixPlot])
+            tasks.append((render.drawSurvival, (p.survivalPath %(item['run']), self.__d, curves, item['run'])))
+        return tasks
 
-            path = p.survivalPath %(item['run'])
-            plt.tight_layout()
-            plt.savefig(path, dpi=240)
-            plt.close('all')
+    def __openMap(self, path):
+        """A p(det) table on the pixels of nsideDet"""
+        return moc.openMap(path, p.nsideDet)
 
-    def __survivalMap(self, DL, RA, Dec, gmstrad, pofdPath):
+    def __survivalMaps(self, DL, gmstrad, pofdPath):
         """
-        Returns the probability of detection when given luminosity distance (Mpc),right ascension,
-        declination, and time (radians)
+        Returns the probability of detection at each pixel centre for every luminosity
+        distance in DL (Mpc), at time gmstrad (radians), as an array (nPix, len(DL))
         """
-        pofd_dLRADec = cf.openPickle(pofdPath)
+        pofd_dLRADec = self.__cache.get(pofdPath, self.__openMap)
         survivalFunc = scipy.interpolate.interp1d(self.__d, pofd_dLRADec, bounds_error=False, fill_value=1e-10)
-        hpxmap = survivalFunc(DL)[self.__pixArr]
-        return hp.get_interp_val(hpxmap, np.pi/2.0 - Dec, RA - gmstrad)
+        hpxmaps = survivalFunc(DL)
+        pix, w = hp.get_interp_weights(p.nsideDet, np.pi/2.0 - self.__dec, self.__ra - gmstrad)
+        return np.sum(hpxmaps[pix]*w[:, :, None], 0)
 
-    def plotDistribution(self, gmstrad=0.0):
+    def distributionTasks(self, gmstrad=0.0):
+        """Render tasks of the mollview of p(det) at a set of distances, for each run"""
+        import render
         dist = np.arange(100, 2500, 100)
+        tasks = []
         for item in p.runsList:
-            for d in dist:
-                desc = 'Mollview probability of detection, run %s' %(item['run'])
-                unit = '$p(D|\Omega, d_L = %d  Mpc, I)$' % (d)
+            hpxmaps = self.__survivalMaps(dist, gmstrad, item['pofdPath'])
+            for k, d in enumerate(dist):
+                unit = '$p(D|\\Omega, d_L = %d  Mpc, I)$' % (d)
                 path = p.distPath %(item['run'], str(d))
-                plt.figure()
-                hpxmap = np.zeros(self.__nPix, dtype=np.float)
-                hpxmap[self.__pixArr] = self.__survivalMap(d, self.__ra, self.__dec, gmstrad, item['pofdPath'])[self.__pixArr]
-                hp.mollview(hpxmap, unit=unit, min = 0, max = round(max(hpxmap),6))
-                plt.savefig(path, dpi=p.dpi)
-                plt.close('all')
+                tasks.append((render.drawMollview, (path, hpxmaps[:, k], unit)))
+        return tasks
+
+    def plotSamples(self):
+        import render
+        render.render(self.samplesTasks())
+
+    def plotSurvival(self):
+        """Plots the survival graph as a function of distance for each pixel, for each run"""
+        import render
+        render.render(self.survivalTasks(), p.pools)
+
+    def plotDistribution(self, gmstrad=0.0):
+        import render
+        render.render(self.distributionTasks(gmstrad), p.pools)
+
+    def plotPSD(self):
+        import render
+        render.render(self.psdTasks(), p.pools)
 
     def run(self, data=False, plots=True):
         if data == True:
             self.generatePofD_DLRADec_events()
         if plots == True:
-            self.plotDistribution()
-            self.plotSurvival()
-            self.plotSamples()
+            import render
+            tasks = self.distributionTasks() + self.survivalTasks() + self.samplesTasks() + self.psdTasks()
+            render.render(tasks, p.pools)
 
 def main():
     probDet = Pofd()
@@ -3,14 +3,101 @@ import healpy as hp
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-from pathos.multiprocessing import ProcessingPool
 import time
+import os
 import lal
 import scipy.interpolate
 import scipy.integrate
 
 import setup as p
 import common_func as cf
+import rings
+import moc
+import sketch
+
+
+def pdfDist(d):
+    """Return the probability of the given distance (!!!Static universe model!!!)"""
+    return 3.0/np.power(p.dmax, 3)*np.power(d, 2)
+
+
+def skySamples(path):
+    """Right ascension and declination of the posterior samples in path"""
+    s = cf.loadSamples(path)
+    try:
+        return np.array(s['right_ascension']), np.array(s['declination'])
+    except ValueError: # in case the data uses 'ra' and 'dec' instead
+        return np.array(s['ra']), np.array(s['dec'])
+
+
+def obsTimes(path):
+    """Observing segments of a run"""
+    return np.genfromtxt(path, names=True)
+
+
+def margPath(pofdMargPath, name, index):
+    """Where the map marginalised over the index-th prior of p.margPriors, called name, is saved"""
+    if index == 0:
+        return pofdMargPath
+    root, ext = os.path.splitext(pofdMargPath)
+    return root + '_' + name + ext
+
+
+def comovingPdf(H0=None, Om0=None, nz=4096):
+    """
+    Returns the probability density of luminosity distances (Mpc) of sources
+    uniform in comoving volume and source frame time, in a flat LambdaCDM
+    universe, normalised on [1, dmax]
+    """
+    H0 = p.H0 if H0 is None else H0
+    Om0 = p.Om0 if Om0 is None else Om0
+    dH = p.c/1e3/H0 # Hubble distance in Mpc
+    z = np.linspace(0.0, 1.0, nz)
+    # extend the redshift grid until it covers dmax
+    while (1 + z[-1])*dH*scipy.integrate.trapezoid(1.0/np.sqrt(Om0*(1 + z)**3 + 1 - Om0), z) < p.dmax:
+        z = np.linspace(0.0, 2*z[-1], nz)
+    E = np.sqrt(Om0*(1 + z)**3 + 1 - Om0)
+    dC = dH*scipy.integrate.cumulative_trapezoid(1.0/E, z, initial=0)
+    dL = (1 + z)*dC
+    # dV/dz/(1 + z) divided by ddL/dz
+    density = dC**2/E/(1 + z)/(dC + (1 + z)*dH/E)
+    d = np.linspace(1, p.dmax, nz)
+    norm = scipy.integrate.trapezoid(np.interp(d, dL, density), d)
+    return lambda d: np.interp(d, dL, density)/norm
+
+
+def distPrior(spec):
+    """
+    Distance prior of an entry of p.margPriors: 'euclidean', 'comoving', or
+    a (name, pdf) pair for any other prior. Returns the name and the pdf
+    """
+    if spec == 'euclidean':
+        return spec, pdfDist
+    if spec == 'comoving':
+        return spec, comovingPdf()
+    if isinstance(spec, tuple) and len(spec) == 2:
+        return spec
+    raise ValueError('ERROR. %s is not a valid distance prior.' % (str(spec)))
+
+
+def margWeights(DL, pdfs, refine=32):
+    """
+    Quadrature weights (len(DL), len(pdfs)) such that table @ weights is
+    the integral over [DL[0], DL[-1]] of the linear interpolation of each row
+    of table times each pdf. The integral of each interpolating hat function
+    times the pdf is done on a grid refine times finer than DL.
+    """
+    n = DL.size
+    x = np.linspace(DL[0], DL[-1], (n - 1)*refine + 1)
+    lo = np.minimum(np.searchsorted(DL, x, side='right') - 1, n - 2)
+    frac = (x - DL[lo])/(DL[lo + 1] - DL[lo])
+    trap = np.full(x.size, x[1] - x[0])
+    trap[[0, -1]] *= 0.5
+    weights = np.empty((n, len(pdfs)))
+    for j, pdf in enumerate(pdfs):
+        w = trap*pdf(x)
+        weights[:, j] = np.bincount(lo, w*(1.0 - frac), minlength=n) + np.bincount(lo + 1, w*frac, minlength=n)
+    return weights
 
 
 class PofdMarg:
@@ -19,110 +106,103 @@ class PofdMarg:
         self.__nPix = hp.nside2npix(p.nsideDet)
         self.__pixArr = range(self.__nPix)
         self.__pixArea = hp.nside2pixarea(p.nsideDet)
+        self.__cache = cf.productCache(p.cacheBytes)
         self.loadEvents()
         self.loadRuns()
 
     def loadEvents(self):
+        """
+        Records of the events. The posterior samples and p(det) products are
+        only read when they are looked up, through the shared product cache
+        """
         self.eventsList = []
         for item in p.eventsList:
-            try:
-                s = cf.loadSamples(item['postSamplePath'])
-                dictData = {'run': item['run'],
+            dictData = cf.LazyRecord({'run': item['run'],
                         'name': item['name'],
-                        'right_ascension': s['right_ascension'],
-                        'declination': s['declination'],
+                        'right_ascension': cf.Lazy(self.__sky, item['postSamplePath'], 0),
+                        'declination': cf.Lazy(self.__sky, item['postSamplePath'], 1),
                         'time0': item['time'],
-                        'pofdMarg': cf.openPickle(item['pofdMargPath']),
-                        'pofd': cf.openPickle(item['pofdPath']),}
-                self.eventsList.append(dictData)
-            except ValueError: # in case the data uses 'ra' and 'dec' instead
-                s = cf.loadSamples(item['postSamplePath'])
-                dictData = {'run': item['run'],
-                        'name': item['name'],
-                        'right_ascension': s['ra'],
-                        'declination': s['dec'],
-                        'time0': item['time'],
-                        'pofdMarg': cf.openPickle(item['pofdMargPath']),
-                        'pofd': cf.openPickle(item['pofdPath']),}
-                self.eventsList.append(dictData)
-                
-                
+                        'pofdMarg': cf.Lazy(self.__cache.get, item['pofdMargPath'], moc.openMap),
+                        'pofd': cf.Lazy(self.__cache.get, item['pofdPath'], cf.openProduct),})
+            self.eventsList.append(dictData)
+
+    def __sky(self, path, index):
+        return self.__cache.get(path, skySamples)[index]
+
     def loadRuns(self):
+        """Records of the runs, read lazily like the events"""
         self.runsList = []
         for item in p.runsList:
-            dictData = {'run': item['run'],
-                        'obsTime': np.genfromtxt(item['obsTpath'], names=True),
-                        'pofd': cf.openPickle(item['pofdPath']),
-                        'pofdMarg': cf.openPickle(item['pofdMargPath']),
-                        'pofdMean': cf.openPickle(item['pofdAvPath']),}
+            dictData = cf.LazyRecord({'run': item['run'],
+                        'obsTime': cf.Lazy(self.__cache.get, item['obsTpath'], obsTimes),
+                        'pofd': cf.Lazy(self.__cache.get, item['pofdPath'], cf.openProduct),
+                        'pofdMarg': cf.Lazy(self.__cache.get, item['pofdMargPath'], moc.openMap),
+                        'pofdMean': cf.Lazy(self.__cache.get, item['pofdAvPath'], cf.openProduct),})
             self.runsList.append(dictData)
 
-    def __survivalFunc(self, dataPofd):
-        """
-        Returns the interpolated function of the probability of detection
-        at a given distance at each pixel.
-        """
-        return scipy.interpolate.interp1d(self.__DL, dataPofd, bounds_error=False, fill_value=1e-10)
-
+    def __productMeta(self, inputPath):
+        """Metadata header of a map derived from the product at inputPath"""
+        return {'nside': p.nsideDet,
+                'provenance': {'source': 'pofd_marg.py',
+                               'input': os.path.basename(cf.productPaths(inputPath)[0])}}
 
-    def __pdfDet(self, d, RA, Dec, survFunc, gmstrad=0.0):
+    def __marginalise(self, item, itemPath):
         """
-        Returns the probability of detection when given luminosity distance (Mpc),
-        right ascension, declination, and time (radians)
+        Distance marginalised p(det) of a run or event for every prior in
+        p.margPriors, as one product of the table with the quadrature
+        weights of all the priors. The first prior is saved to pofdMargPath,
+        the others next to it (see margPath). With p.margFromSketch it comes
+        from the quantile sketch of the table (see sketch.PofdSketch.marginal)
+        when there is one. A multi-order table gives multi-order maps with
+        the same cells.
         """
-        hpxmap = survFunc(d)[self.__pixArr]
-        return hp.get_interp_val(hpxmap, np.pi/2.0 - Dec, RA - gmstrad)
-
-    def __pdfDist(self, d):
-        """Return the probability of the given distance (!!!Static universe model!!!)"""
-        return 3.0/np.power(p.dmax, 3)*np.power(d, 2)
-
-    def __margPdfDet(self, RA, Dec, survFunc):
-        """Returns the marginalised (over distance) probability of detection at a given sky position."""
-        I = lambda x: self.__pdfDet(x, RA, Dec, survFunc)*self.__pdfDist(x)
-        return scipy.integrate.quad(I, 1, p.dmax)[0]
+        names, pdfs = zip(*[distPrior(spec) for spec in p.margPriors])
+        meta = self.__productMeta(itemPath['pofdPath'])
+        sketchFile = cf.productPaths(sketch.sketchPath(itemPath['pofdPath']))[0]
+        if p.margFromSketch and os.path.exists(sketchFile):
+            probSketch = sketch.openSketch(itemPath['pofdPath'])
+            result = np.stack([probSketch.marginal(pdf, 1, p.dmax) for pdf in pdfs], 1)
+            uniq = None
+            meta['provenance']['input'] = os.path.basename(sketchFile)
+        else:
+            table = item['pofd']
+            weights = margWeights(self.__DL, pdfs)
+            result = np.empty((len(table), len(pdfs)))
+            for start in range(0, len(table), p.margBlock):
+                result[start:start + p.margBlock] = np.matmul(table[start:start + p.margBlock], weights)
+            uniq = moc.openMoc(itemPath['pofdPath'])[0] if moc.isMoc(itemPath['pofdPath']) else None
+        if uniq is not None:
+            # opened at the same order as the table
+            meta['moc'] = cf.productMeta(itemPath['pofdPath']).get('moc')
+            meta['nside'] = moc.mapNside(itemPath['pofdPath'])
+            if meta['moc'] is None:
+                del meta['moc']
+        for j, name in enumerate(names):
+            path = margPath(itemPath['pofdMargPath'], name, j)
+            meta['prior'] = name
+            if uniq is not None:
+                moc.saveMoc(uniq, result[:, j], path, **meta)
+            else:
+                if moc.isMoc(path):
+                    os.remove(moc.uniqPath(path))
+                cf.saveProduct(result[:, j], path, **meta)
+        return result[:, 0]
 
     def __calculGrid(self):
         """Calculate the marginalised probability of detection on a grid"""
-        pool = ProcessingPool(p.pools)
-        theta, phi = hp.pix2ang(p.nsideDet, self.__pixArr)
-        raGrid, decGrid = phi, np.pi/2 - theta
-
         for item, itemPath in zip(self.runsList, p.runsList):
-            survFunc = self.__survivalFunc(item['pofd'])
             print('Computing the grid for %s' % item['run'])
-            def loopKiller(i):
-                return self.__margPdfDet(raGrid[i], decGrid[i], survFunc)
-            loopOut = pool.map(loopKiller, range(self.__nPix))
-            result = np.hstack(loopOut)
-            cf.savePickle(result, itemPath['pofdMargPath'])
+            result = self.__marginalise(item, itemPath)
             print('Calculated the grid!')
         self.loadRuns()
-        pool.close()
-        pool.join()
-        pool.clear()
 
-        pool = ProcessingPool(p.pools)
-        theta, phi = hp.pix2ang(p.nsideDet, self.__pixArr)
-        raGrid, decGrid = phi, np.pi/2 - theta
         for item, itemPath in zip(self.eventsList, p.eventsList):
             print('pofd shape, ', item['pofd'].shape)
-            survFunc = self.__survivalFunc(item['pofd'])
             print('Computing the grid for %s' % item['name'])
-            def loopKiller(i):
-                return self.__margPdfDet(raGrid[i], decGrid[i], survFunc)
-            loopOut = pool.map(loopKiller, range(self.__nPix))
-            result = np.hstack(loopOut)
+            result = self.__marginalise(item, itemPath)
             print('result shape, ', result.shape)
-            cf.savePickle(result, itemPath['pofdMargPath'])
             print('Calculated the grid!')
-            self.loadRuns()
-        pool.close()
-        pool.join()
-        pool.clear()
-
-    def __pdfDetMargInterp(self, RA, Dec, mapDet, gmstrad):
-        return hp.get_interp_val(mapDet, np.pi/2.0 - Dec, RA - gmstrad)
+        self.loadRuns()
 
     def __gps2rad(self, gps):
         gpsLigo = lal.LIGOTimeGPS(gps)
@@ -131,37 +211,21 @@ class PofdMarg:
     def __pdfDetRotation(self):
         """Calculaters the average the probability of detection over the run period"""
         self.loadRuns()
-        pool = ProcessingPool(p.pools)
         for itemPath, itemRun in zip(p.runsList, self.runsList):
-            obj = itemRun['pofdMarg']
-            mapDet = obj[self.__pixArr]
-            theta, phi = hp.pix2ang(p.nsideDet, self.__pixArr)
-            RA, Dec = phi, np.pi/2.0 - theta
+            mapDet = np.asarray(itemRun['pofdMarg'])
 
             data = itemRun['obsTime']
             gmstStart = data['GMSTstart']
             gmstEnd = data['GMSTend']
-            obsTime = np.sum(gmstEnd - gmstStart)
-            N = gmstStart.size
 
             print('Averaging pdf of detection over one day for %s' %(itemRun['run']))
             start = time.time()
-            def loopKiller(i):
-                res = np.zeros(self.__nPix)
-                for j in range(self.__nPix):
-                    I = lambda t: self.__pdfDetMargInterp(RA[j], Dec[j], mapDet, t)
-                    res[j] = scipy.integrate.quad(I, gmstStart[i], gmstEnd[i])[0]
-                return res
-
-            loopOut = pool.map(loopKiller, range(N))
-            loopOut = np.vstack(loopOut)
-            result = np.sum(loopOut, axis=0)/obsTime
-            cf.savePickle(result, itemPath['pofdAvPath'])
+            result = rings.ringAverage(mapDet, gmstStart, gmstEnd, p.exposureBins)
+            meta = self.__productMeta(itemPath['pofdMargPath'])
+            meta['nside'] = hp.npix2nside(mapDet.size)
+            cf.saveProduct(result, itemPath['pofdAvPath'], **meta)
             print('Done with taking the average for %s!' %(itemRun['run']))
             print('Time taken: %.3f' %(time.time() - start))
-        pool.close()
-        pool.join()
-        pool.clear()
 
     def plotMap(self, hpMap, path, events):
         plt.rcParams['font.serif']='Times New Roman' # Text font
@@ -208,8 +272,7 @@ class PofdMarg:
             for run in self.runsList:
                 print('Plotting '+run['run'])
                 path = p.mapPath %(run['run'])
-                obj = run['pofdMean']
-                hpMap = obj[self.__pixArr]
+                hpMap = np.asarray(run['pofdMean'])
                 self.plotMap(hpMap=hpMap, path = path, events = [])
                 events=[e for e in self.eventsList if e['run']==run['run']]
                 if len(events) > 7:
@@ -221,8 +284,7 @@ class PofdMarg:
             for event in self.eventsList:
                 print('Plotting '+event['name'])
                 path = p.mapPath %(event['name'])
-                obj = event['pofdMarg']
-                hpMap = obj[self.__pixArr]
+                hpMap = np.asarray(event['pofdMarg'])
                 self.plotMap(hpMap=hpMap, path=path, events=[event])
 
 def main():
@@ -0,0 +1,94 @@
+"""
+Render stage: draws figures from products that have already been computed.
+
+A task is a (function, args) tuple where function is one of the module
+level draw functions below and args are the arrays to draw, already
+evaluated, and the output path. Tasks are independent, so render() spreads
+them over a pool of processes. pofd.py only imports this module inside its
+*Tasks and plot methods, so a data only run does no plotting and never
+sets the backend (healpy still imports matplotlib on its own).
+"""
+import numpy as np
+import healpy as hp
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import multiprocessing
+
+import setup as p
+
+
+def _draw(task):
+    func, args = task
+    func(*args)
+    return args[0]
+
+
+def render(tasks, processes=1):
+    """Draws all the tasks, in a pool of processes if there is more than one"""
+    tasks = list(tasks)
+    processes = min(processes, len(tasks))
+    if processes <= 1:
+        for task in tasks:
+            _draw(task)
+        return
+    with multiprocessing.Pool(processes) as pool:
+        for path in pool.imap_unordered(_draw, tasks):
+            pass
+
+
+def drawPsd(path, freq, asd):
+    """Amplitude spectral density of a detector"""
+    plt.figure()
+    plt.loglog(freq, asd)
+    plt.savefig(path, dpi=p.dpi)
+    plt.close('all')
+
+
+def drawSamples(path, panels):
+    """
+    Histograms of the Monte Carlo samples on a 2x3 grid, panels being a
+    list of (values, xlabel, ylabel)
+    """
+    fig,ax = plt.subplots(2, 3)
+    plt.subplots_adjust(wspace= 0.7)
+    plt.suptitle('Distribution of samples')
+    for axis, (values, xlabel, ylabel) in zip(ax.ravel(), panels):
+        axis.hist(values, bins='auto')
+        axis.set_xlabel(xlabel)
+        axis.set_ylabel(ylabel)
+    plt.savefig(path, dpi=p.dpi)
+    plt.close('all')
+
+
+def drawSurvival(path, d, curves, run):
+    """p(det) against distance, one curve per row of curves"""
+    plt.rcParams['font.serif']='Times New Roman' # Text font
+    plt.rcParams['font.family']='serif'
+    plt.rcParams['font.size']=8
+    plt.rcParams['text.usetex']=False
+    plt.rcParams['mathtext.fontset']='cm' #Computer Modern font
+    figwidth=3.4 # PRD column width in inches
+    aspect = 0.75 # Aspect ratio
+
+    figheight = aspect*figwidth
+    plt.figure(figsize=(figwidth,figheight),dpi=240)
+    for curve in curves:
+        plt.plot(d, curve)
+    plt.xlabel('$d_L$ (Mpc)')
+    plt.ylabel('$p(D|d_L,t = {0}, I)$'.format(run))
+    if run == 'O3b':
+        plt.xlim(xmin=0, xmax=4000)
+    else:
+        plt.xlim(xmin=0, xmax=2000)
+    plt.tight_layout()
+    plt.savefig(path, dpi=240)
+    plt.close('all')
+
+
+def drawMollview(path, hpxmap, unit):
+    """Mollweide projection of a healpy map"""
+    plt.figure()
+    hp.mollview(hpxmap, unit=unit, min = 0, max = round(max(hpxmap),6))
+    plt.savefig(path, dpi=p.dpi)
+    plt.close('all')
@@ -0,0 +1,97 @@
+"""
+p(det|dist, RA, Dec) for other mass populations, by importance reweighting
+the Monte Carlo samples stored by Pofd when setup.storeSnr is True.
+
+The stored file holds, for every pixel and sample, the optimal network
+SNR**2 at 1 Mpc (as float32), together with the sample masses and the log
+density they were drawn from. For a target population p the samples get weights
+w_n = p(m1_n, m2_n)/q(m1_n, m2_n), and
+
+    p(det|d, pixel) = sum_n w_n sf(rho_n**2/d**2) / sum_n w_n
+
+The survival only depends on log(rho**2) - 2 log(d), so the weights of each
+pixel are binned in log(rho**2) (linear cloud in cell) and the table is one
+matrix product of the (pixel x bin) weights with the (bin x distance)
+survival kernel, shared by all pixels.
+"""
+import numpy as np
+import os
+
+import setup as p
+import common_func as cf
+import survival
+
+
+def massLogDensity(m1, m2, alpha, mmin, mmax):
+    """
+    Log density of the masses (in solar masses) drawn by Pofd: m1 power law
+    with index -alpha on [mmin, mmax - mmin], m2 uniform on
+    [mmin, min(m1, mmax - m1)]. -inf outside the support.
+    """
+    m1, m2 = np.asarray(m1, dtype=np.float64), np.asarray(m2, dtype=np.float64)
+    normConst = 1.0/(1-alpha)*(np.power(mmax-mmin, 1-alpha)-np.power(mmin, 1-alpha))
+    lim = np.minimum(m1, mmax - m1)
+    inside = (m1 >= mmin) & (m1 <= mmax - mmin) & (m2 >= mmin) & (m2 <= lim)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logp = -alpha*np.log(m1) - np.log(normConst) - np.log(lim - mmin)
+    return np.where(inside, logp, -np.inf)
+
+
+def snrPath(pofdPath):
+    """Where Pofd stores the per-sample SNR**2 of the table saved at pofdPath"""
+    root, ext = os.path.splitext(pofdPath)
+    return root + '_snr' + ext
+
+
+def weightsOf(data, logDensity):
+    """Normalised importance weights of the stored samples and their effective sample size"""
+    logw = logDensity(data['m1'], data['m2']) - data['logq']
+    if not np.any(np.isfinite(logw)):
+        raise ValueError('the target population has no support on the stored samples')
+    w = np.exp(logw - np.max(logw))
+    w /= np.sum(w)
+    return w, 1.0/np.sum(w**2)
+
+
+def reweightPofd(path, alpha=p.alpha, mmin=p.mmin, mmax=p.mmax, logDensity=None, nBins=2048):
+    """
+    p(det|dist, RA, Dec) for a different mass population.
+
+    Parameters:
+        path: str
+            Per-sample SNR file written by Pofd (see snrPath)
+        alpha, mmin, mmax: float
+            Parameters of the target population, same family as Pofd's
+        logDensity: py:func (default None)
+            log p(m1, m2) of any other target population, in solar masses.
+            Overrides alpha, mmin, mmax.
+        nBins: int (default 2048)
+            Bins in log(rho**2) for the survival kernel
+    Returns:
+        table: array (nPix, dsize)
+            p(det) on the stored distance grid
+        ess: float
+            Effective number of samples after reweighting
+    """
+    data = cf.openPickle(path)
+    if logDensity is None:
+        logDensity = lambda m1, m2: massLogDensity(m1, m2, alpha, mmin, mmax)
+    w, ess = weightsOf(data, logDensity)
+    keep = w > 0
+    w = w[keep]
+    x = np.log(np.maximum(data['rho'][:, keep], np.finfo(np.float32).tiny).astype(np.float64))
+    nPix = x.shape[0]
+
+    # cloud in cell weights of each pixel on the log(rho**2) grid
+    grid = np.linspace(np.min(x), np.max(x) + 1e-12, nBins)
+    pos = (x - grid[0])/(grid[1] - grid[0])
+    lo = np.minimum(np.floor(pos).astype(int), nBins - 2)
+    frac = pos - lo
+    rows = (np.arange(nPix)*nBins)[:, None]
+    binned = np.bincount((rows + lo).ravel(), (w*(1.0 - frac)).ravel(), minlength=nPix*nBins) \
+             + np.bincount((rows + lo + 1).ravel(), (w*frac).ravel(), minlength=nPix*nBins)
+    binned = binned.reshape((nPix, nBins))
+
+    survivalFunc = survival.ncxSurvival(data['threshold'], 4, p.survivalTol)
+    kernel = survivalFunc(np.exp(grid)[:, None]/data['d']**2)
+    return np.matmul(binned, kernel), ess
@@ -0,0 +1,115 @@
+"""
+Ring-wise operations on HEALPix maps in RING ordering.
+
+Every HEALPix ring is an equally spaced set of pixels at constant
+declination. A rotation about the celestial pole (a change in GMST) only
+moves values along a ring, so it can be applied ring by ring as a periodic
+1D interpolation in phi.
+"""
+import numpy as np
+import healpy as hp
+
+
+def ringLayout(nside):
+    """Returns the first pixel, the number of pixels and the phi of the first pixel of every ring"""
+    startpix, ringpix = hp.ringinfo(nside, np.arange(1, 4*nside))[:2]
+    phi0 = hp.pix2ang(nside, startpix)[1]
+    return startpix, ringpix, phi0
+
+
+def ringGrid(nside, oversample=1):
+    """
+    RA and Dec of a sidereal-aligned grid. Each ring of the HEALPix map is
+    sampled at 'oversample' times its pixel density in phi, so that every
+    pixel centre is on the grid. Returned ring after ring, so that ring r
+    starts at oversample*startpix[r].
+    """
+    startpix, ringpix, phi0 = ringLayout(nside)
+    theta = hp.pix2ang(nside, startpix)[0]
+    ra, dec = [], []
+    for n, t, f in zip(ringpix, theta, phi0):
+        m = n*oversample
+        ra.append(f + 2.0*np.pi*np.arange(m)/m)
+        dec.append(np.full(m, np.pi/2.0 - t))
+    return np.concatenate(ra), np.concatenate(dec)
+
+
+def ringShift(table, nside, dphi, oversample=1):
+    """
+    Evaluates a table on the sidereal-aligned grid (see ringGrid) at
+    phi - dphi for each pixel centre, by periodic Catmull-Rom (cubic)
+    interpolation along the rings. The table is indexed by grid point on its first axis,
+    and the result by pixel (RING ordering).
+    """
+    table = np.asarray(table)
+    out = np.empty((hp.nside2npix(nside),) + table.shape[1:], dtype=table.dtype)
+    startpix, ringpix, _ = ringLayout(nside)
+    for start, n in zip(startpix, ringpix):
+        m = n*oversample
+        base = table[oversample*start:oversample*start + m]
+        x = np.mod(np.arange(n)*oversample - dphi*m/(2.0*np.pi), m)
+        lo = np.floor(x).astype(int)
+        t = (x - lo).reshape((-1,) + (1,)*(table.ndim - 1))
+        # Catmull-Rom weights of the points lo-1, lo, lo+1, lo+2
+        w = [((2.0 - t)*t - 1.0)*t/2.0,
+             ((3.0*t - 5.0)*t*t + 2.0)/2.0,
+             ((4.0 - 3.0*t)*t + 1.0)*t/2.0,
+             (t - 1.0)*t*t/2.0]
+        out[start:start + n] = sum(wk*base[(lo + k - 1) % m] for k, wk in enumerate(w))
+    return out
+
+
+def exposureProfile(start, end, nBins):
+    """
+    Time spent at each gmst, from observing segments [start, end] (radians,
+    any number of turns), binned into nBins equal bins of [0, 2 pi). The
+    amount of each segment in each bin is exact.
+    """
+    start, end = np.asarray(start, dtype=np.float64), np.asarray(end, dtype=np.float64)
+    length = end - start
+    turns = np.floor(length/(2.0*np.pi))
+    rest = length - 2.0*np.pi*turns
+    a = np.mod(start, 2.0*np.pi)
+    edges = np.linspace(0.0, 2.0*np.pi, nBins + 1)
+    def covered(u):
+        # time of a segment of length rest starting at 0 that falls in [0, u) modulo 2 pi
+        return np.floor(u/(2.0*np.pi))*rest + np.minimum(np.mod(u, 2.0*np.pi), rest)
+    profile = np.sum(covered(edges[1:, None] - a) - covered(edges[:-1, None] - a), 1)
+    return profile + np.sum(turns)*2.0*np.pi/nBins
+
+
+def ringAverage(hpMap, start, end, nBins=8192):
+    """
+    Average of a map (RING ordering) over the gmst of the observing segments
+    [start, end], i.e. the mean over the segments of hp.get_interp_val at
+    (theta, phi - gmst) for every pixel centre.
+
+    Along a ring the interpolated map is a sum of triangles centred on the
+    ring's pixels, so the average is a circular convolution of the ring with
+    the triangle integrated against the exposure profile. The profile is
+    binned once; the kernel of each ring length is exact for a profile that
+    is flat within bins, and the convolutions are done by FFT.
+    """
+    hpMap = np.asarray(hpMap, dtype=np.float64)
+    nside = hp.npix2nside(hpMap.size)
+    profile = exposureProfile(start, end, nBins)
+    profile /= np.sum(profile)
+    edges = np.linspace(0.0, 2.0*np.pi, nBins + 1)
+    startpix, ringpix, _ = ringLayout(nside)
+    out = np.empty_like(hpMap)
+    kernels = {}
+    for first, n in zip(startpix, ringpix):
+        if n not in kernels:
+            h = 2.0*np.pi/n
+            x = h*np.arange(n)
+            # offset of each bin from each node, wrapped to [-pi, pi), in units of h
+            lo = (np.mod(x[:, None] - edges[None, 1:] + np.pi, 2.0*np.pi) - np.pi)/h
+            hi = lo + (edges[1] - edges[0])/h
+            # mean of the unit triangle over [lo, hi], from its antiderivative
+            T = lambda s: np.where(s < 0, 0.5*np.square(np.clip(s + 1, 0, 1)),
+                                   0.5 + 0.5*(1 - np.square(1 - np.clip(s, 0, 1))))
+            kernel = np.dot((T(hi) - T(lo))/(hi - lo), profile)
+            kernels[n] = np.fft.rfft(kernel)
+        ring = hpMap[first:first + n]
+        out[first:first + n] = np.fft.irfft(np.fft.rfft(ring)*kernels[n], n)
+    return out
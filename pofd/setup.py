@@ -4,6 +4,7 @@ import os
 
 # Basic constants
 snrThrComb = 12.0
+survivalTol = 1e-6 # max error of the tabulated ncx2 survival function
 mSolar = 1.989e30
 Mpc = 3.0857e22
 c = sc.c
@@ -16,6 +17,17 @@ dsize = 1000
 # Pixels properties
 nside = 1
 nsideDet = 16
+pixBlock = 64 # pixels per block of the p(det) Monte Carlo
+mocMaxOrder = None # if set, p(det) tables are multi-order maps refined from nsideDet up to nside 2**mocMaxOrder
+mocTol = 0.01 # refine cells where p(det) changes by more than this to a neighbouring cell
+
+# Event p(det) maps
+eventPSD = 'event' # 'event' uses the PSDs released with each event, 'run' the analytic PSD of its run
+siderealShift = False # one Monte Carlo per network at gmst = 0, rotated to each event's gmst
+# Events only share a network with eventPSD = 'run'. With 'event' every event has its own PSDs
+# and is computed directly, so siderealShift saves nothing
+siderealOversample = 4 # phi oversampling of the gmst = 0 grid, sets the accuracy of the rotation
+
 dpi = 250
 
 axes = 'rzyz'
@@ -29,6 +41,19 @@ alpha = 2.35
 pools = 24
 mmin = 10
 mmax = 100 # this is outdated, may want to increase for future analyses
+storeSnr = False # keep the per-sample SNR**2 of each table, for reweight.reweightPofd
+storeSketch = False # keep a quantile sketch of the SNR**2 of each pixel, for sketch.PofdSketch
+sketchSize = 64 # quantiles per pixel in the sketch
+margFromSketch = False # PofdMarg marginalises over distance from the sketch instead of the table
+
+# Distance priors of the marginalised maps. 'euclidean', 'comoving' or (name, pdf of d in Mpc).
+# The first one is saved as the _marg map, the others as _marg_<name>
+margPriors = ['euclidean']
+margBlock = 4096 # rows of the table per matrix product in PofdMarg
+exposureBins = 8192 # gmst bins of the sidereal exposure profile of a run
+cacheBytes = 2**31 # memory budget of the cache of loaded products
+H0 = 67.9 # km/s/Mpc, for the comoving prior
+Om0 = 0.3065
 
 # Sampler set up
 nWalk = 1000
@@ -42,6 +67,7 @@ amax = 150
 # Parameters to set up the num calculation
 # nNum = 20000    # number of mass samples to calculate num
 nNum = 500
+numRefine = 256 # integration points per num interval
 fmin = 10       # min frequency
 
 """Location of directory"""
@@ -155,6 +181,8 @@ probPlotPath = DataPath + 'Results/Sampling/Plots/Probability_graph.png'
 rateHistPath = DataPath + 'Results/Sampling/Plots/R_hist_%s_%s'
 pixelHistPath = DataPath + 'Results/Sampling/Plots/Hist_%s'
 PSDpath = parent + 'Results/Pofd/PSD_%s'
+numCachePath = DataPath + 'Data/Cache/NumFmax_%s.p'
+siderealPartialPath = DataPath + 'Data/Cache/Sidereal_%s.p'
 
 
 samplesLastPath = parent + 'Results/Sampling/Data/Samples_last.p'
@@ -0,0 +1,96 @@
+"""
+Distance-free representation of p(det|dist, RA, Dec).
+
+The optimal SNR**2 of every sample scales as 1/d**2, so for a pixel
+
+    p(det|d) = 1/nSamp sum_n sf(rho_n**2/d**2)
+
+depends on the distance only through that scaling. Instead of a table on a
+fixed distance grid, each pixel stores a quantile sketch of its rho**2 at
+1 Mpc: the sorted samples are split into K bins of (nearly) equal counts,
+and each bin is represented by its mean, weighted by its share of the
+samples. p(det) then follows at any distance as the weighted average of
+the survival over the K nodes. Bin means are used rather than the
+quantiles at the bin centres, which are biased where the survival is
+curved; with 500 samples and K = 64 the marginalised map is within 0.05%.
+
+Marginalising over a distance prior, the integral over d is the same
+function of rho**2 for every pixel, so it is tabulated once and the map is
+the average of that function over the nodes of each pixel.
+"""
+import numpy as np
+import os
+import scipy.integrate
+
+import setup as p
+import common_func as cf
+import survival
+
+
+def sketchPath(pofdPath):
+    """Where Pofd stores the quantile sketch of the table saved at pofdPath"""
+    root, ext = os.path.splitext(pofdPath)
+    return root + '_sketch' + ext
+
+
+def sketchWeights(nSamp, size):
+    """Share of the samples in each bin of the sketch"""
+    return np.array([len(b) for b in np.array_split(np.arange(nSamp), size)])/float(nSamp)
+
+
+def quantileSketch(rho, size):
+    """
+    Quantile sketch of each row of rho: the means of size bins of the
+    sorted row, shape (rows, size)
+    """
+    rho = np.sort(rho, 1)
+    return np.stack([rho[:, b].mean(1) for b in np.array_split(np.arange(rho.shape[1]), size)], 1)
+
+
+class PofdSketch(object):
+    """
+    p(det|dist) of a set of pixels from their quantile sketches.
+
+    Parameters:
+        sketch: array (nPix, K)
+            Sketch of the optimal network SNR**2 at 1 Mpc of each pixel
+        weights: array (K,)
+            Share of the samples in each node (see sketchWeights)
+        threshold: float
+            Threshold on the network SNR**2
+    """
+    def __init__(self, sketch, weights, threshold):
+        self.sketch = np.asarray(sketch, dtype=np.float64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.threshold = threshold
+        self.__survival = survival.ncxSurvival(threshold, 4, p.survivalTol)
+
+    def __call__(self, d):
+        """p(det) at the distances d (Mpc) for every pixel, shape (nPix, len(d))"""
+        d = np.atleast_1d(np.asarray(d, dtype=np.float64))
+        out = np.empty((self.sketch.shape[0], d.size))
+        for j, dist in enumerate(d):
+            out[:, j] = np.dot(self.__survival(self.sketch/dist**2), self.weights)
+        return out
+
+    def marginal(self, pdf, dmin, dmax, n=4096):
+        """
+        p(det) of every pixel marginalised over the distance prior pdf on
+        [dmin, dmax]. The distance integral of the survival is tabulated on
+        a grid in log(rho**2) spanning all the nodes, with n distances
+        """
+        d = np.linspace(dmin, dmax, n)
+        w = pdf(d)
+        lo = np.log(max(np.min(self.sketch), np.finfo(float).tiny))
+        hi = np.log(max(np.max(self.sketch), np.finfo(float).tiny)) + 1e-12
+        x = np.linspace(lo, hi, n)
+        kernel = scipy.integrate.trapezoid(self.__survival(np.exp(x)[:, None]/d**2)*w, d, axis=1)
+        logSketch = np.log(np.maximum(self.sketch, np.finfo(float).tiny))
+        return np.dot(np.interp(logSketch, x, kernel), self.weights)
+
+
+def openSketch(pofdPath):
+    """PofdSketch of the table saved at pofdPath"""
+    path = sketchPath(pofdPath)
+    meta = cf.productMeta(path)
+    return PofdSketch(cf.openProduct(path), meta['weights'], meta['threshold'])
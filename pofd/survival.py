@@ -0,0 +1,61 @@
+"""
+Tabulated detection probability for a fixed SNR threshold.
+
+With the threshold and degrees of freedom fixed, scipy.stats.ncx2.sf is a
+1D function of the noncentrality (the optimal SNR**2) alone. It is tabulated
+once, uniformly in the optimal SNR, and evaluated by linear interpolation.
+"""
+import numpy as np
+import scipy.stats
+import functools
+
+
+class NcxSurvival(object):
+    """
+    scipy.stats.ncx2.sf(threshold, df, nc) as a lookup table in nc.
+
+    The number of nodes is doubled until linear interpolation is within
+    tol of scipy at every interval midpoint, where the interpolation error
+    of a smooth function peaks. Above the last node the survival is within
+    tol of 1 and the last tabulated value is returned.
+
+    Parameters:
+        threshold: float
+            Threshold on the network SNR**2
+        df: int (default 4)
+            Degrees of freedom of the non-central chi-squared distribution
+        tol: float (default 1e-6)
+            Maximum absolute error of the table
+    """
+    def __init__(self, threshold, df=4, tol=1e-6):
+        self.threshold = threshold
+        self.df = df
+        self.tol = tol
+        uMax = np.sqrt(threshold)
+        while self.__sf(uMax) < 1.0 - tol/2.0:
+            uMax *= 1.25
+        n = 256
+        while True:
+            u = np.linspace(0.0, uMax, n + 1)
+            sf = self.__sf(u)
+            mid = 0.5*(u[1:] + u[:-1])
+            err = np.max(np.abs(np.interp(mid, u, sf) - self.__sf(mid)))
+            if err <= tol:
+                break
+            n *= 2
+        self.__u = u
+        self.__table = sf
+        self.maxError = err
+
+    def __sf(self, u):
+        return scipy.stats.ncx2.sf(self.threshold, self.df, u**2)
+
+    def __call__(self, nc):
+        """Survival probability for an array of noncentralities"""
+        return np.interp(np.sqrt(nc), self.__u, self.__table)
+
+
+@functools.lru_cache(maxsize=None)
+def ncxSurvival(threshold, df=4, tol=1e-6):
+    """NcxSurvival table, built once per process for each threshold"""
+    return NcxSurvival(threshold, df, tol)